@@ -0,0 +1,82 @@
+"""Encode time, decode time and size of the output codecs on a sample of prepared images.
+
+Every codec is lossless, the decoded images are checked against the originals.
+
+Usage (from the repository root):
+    python -m benchmarks.codec_bench ./data/roi-severity_synthetized --samples 200 --output codecs.json
+"""
+import io
+import cv2
+import json
+import time
+import argparse
+import numpy as np
+from src.reader.dataset import PreparedDataset
+from src.utils.codecs import encode_image
+from src.utils.formats import EXTENSIONS
+
+
+def decode_image(data: bytes, output_format: str):
+    """Decode an image encoded by encode_image"""
+    if output_format == 'npy':
+        return np.load(io.BytesIO(data))
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def same_pixels(image, decoded):
+    # WebP stores grayscale images as 3 identical channels
+    if image.ndim == 2 and decoded.ndim == 3:
+        decoded = decoded[..., 0]
+    return np.array_equal(image, decoded)
+
+
+def bench_codec(images: list, output_format: str, png_compression: int = None):
+    """Total encode and decode times and encoded size of the images"""
+    encode_seconds = decode_seconds = 0.0
+    size = 0
+    for image in images:
+        start = time.perf_counter()
+        data = encode_image(image, output_format, png_compression)
+        encode_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = decode_image(data, output_format)
+        decode_seconds += time.perf_counter() - start
+        if not same_pixels(image, decoded):
+            raise ValueError(f'{output_format} did not preserve the pixels')
+        size += len(data)
+    return {'encode_seconds': encode_seconds, 'decode_seconds': decode_seconds, 'bytes': size,
+            'encode_ms_per_image': encode_seconds / len(images) * 1e3,
+            'decode_ms_per_image': decode_seconds / len(images) * 1e3,
+            'kb_per_image': size / len(images) / 1024}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Output codec benchmark")
+    parser.add_argument("task_dir", type=str, help="Prepared task folder, e.g. ./data/roi-severity")
+    parser.add_argument("--split", type=str, default='train')
+    parser.add_argument("--samples", type=int, default=100, help="Number of images sampled from the task")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="JSON result file")
+    args = parser.parse_args()
+
+    dataset = PreparedDataset(args.task_dir, args.split, cache_size=0)
+    rng = np.random.default_rng(args.seed)
+    indices = rng.choice(len(dataset), min(args.samples, len(dataset)), replace=False)
+    images = [np.ascontiguousarray(dataset.get_image(i)) for i in indices]
+    raw_kb = sum(image.nbytes for image in images) / len(images) / 1024
+    print(f'{len(images)} images of {args.task_dir}, {images[0].shape} {raw_kb:.0f} kB raw')
+
+    codecs = [('png', None)] + [('png', level) for level in range(10)] + \
+        [(output_format, None) for output_format in EXTENSIONS if output_format != 'png']
+    results = {}
+    print(f"{'codec':10s} {'encode ms':>10s} {'decode ms':>10s} {'kB':>8s} {'ratio':>6s}")
+    for output_format, png_compression in codecs:
+        name = output_format if png_compression is None else f'{output_format}-{png_compression}'
+        results[name] = bench_codec(images, output_format, png_compression)
+        r = results[name]
+        print(f"{name:10s} {r['encode_ms_per_image']:10.2f} {r['decode_ms_per_image']:10.2f} "
+              f"{r['kb_per_image']:8.1f} {raw_kb / r['kb_per_image']:6.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'task_dir': args.task_dir, 'samples': len(images), 'codecs': results}, f, indent=2)
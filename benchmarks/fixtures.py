@@ -0,0 +1,151 @@
+"""Synthetic CBIS-DDSM like dataset used by the benchmarks.
+
+The generated folder has the layout of the original dataset: a ``metadata.csv`` file,
+the four ``*_case_description_*_set.csv`` files and one folder per DICOM series,
+with 16 bits mammograms stored as MONOCHROME1 or MONOCHROME2 and ROI series holding
+either the mask alone or the mask and the cropped image, as in the TCIA release.
+Some mammograms hold a second abnormality, described by its own row.
+
+Usage (from the repository root):
+    python -m benchmarks.fixtures /tmp/cbis --cases 16 --height 2048 --width 1536
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+DIGITAL_MAMMOGRAPHY_SOP_CLASS = '1.2.840.10008.5.1.4.1.1.1.2'
+PATHOLOGIES = ['BENIGN', 'MALIGNANT', 'BENIGN_WITHOUT_CALLBACK']
+
+
+def write_dicom(path: str, pixels: np.array, photometric: str = 'MONOCHROME2'):
+    """Save a 2D uint16 array as an uncompressed DICOM file
+
+    Args:
+        path (str): output file path, its folder is created
+        pixels (np.array): 2D image
+        photometric (str): 'MONOCHROME1' or 'MONOCHROME2'
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = DIGITAL_MAMMOGRAPHY_SOP_CLASS
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Rows, ds.Columns = pixels.shape
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.PixelData = pixels.astype(np.uint16).tobytes()
+    ds.save_as(path, enforce_file_format=True)
+
+
+def make_mammogram(rng: np.random.Generator, shape: tuple, left: bool = True):
+    """Half ellipse of tissue against a dark background, with 12 bits noise"""
+    height, width = shape
+    y, x = np.ogrid[:height, :width]
+    cx = 0 if left else width - 1
+    breast = ((x - cx) / (0.7 * width)) ** 2 + ((y - height / 2) / (0.45 * height)) ** 2 <= 1
+    image = rng.integers(0, 200, size=shape, dtype=np.uint16)
+    image[breast] += rng.integers(1500, 3500, size=int(breast.sum()), dtype=np.uint16)
+    return image
+
+
+def make_mask(rng: np.random.Generator, shape: tuple):
+    """Binary lesion mask, an ellipse placed inside the breast area"""
+    height, width = shape
+    ry, rx = rng.integers(height // 40, height // 10), rng.integers(width // 40, width // 10)
+    cy, cx = rng.integers(height // 4, 3 * height // 4), rng.integers(rx + 1, width // 2)
+    y, x = np.ogrid[:height, :width]
+    return ((((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2) <= 1).astype(np.uint16) * 255
+
+
+def make_cbis_tree(root: str, cases: int = 8, shape: tuple = (1024, 768), seed: int = 0, shared: float = 0.25):
+    """Generate a synthetic CBIS-DDSM folder
+
+    Args:
+        root (str): output folder, used as data_dir by the preparation
+        cases (int): number of mammograms of each of the four case description files
+        shape (tuple): (height, width) of the mammograms
+        seed (int): random seed
+        shared (float): share of the mammograms holding a second abnormality
+
+    Returns:
+        int: number of DICOM files written
+    """
+    rng = np.random.default_rng(seed)
+    metadata_rows = []
+    n_files = 0
+
+    def add_series(name: str):
+        study, series = generate_uid(), generate_uid()
+        folder = f'{series[-5:]}'
+        metadata_rows.append({'Series UID': series, 'Study UID': study,
+                              'File Location': f'.\\CBIS-DDSM\\{name}\\{study}\\1-{folder}'})
+        return os.path.join(root, 'CBIS-DDSM', name, study, f'01-{folder}'), f'{name}/{study}/{series}'
+
+    for desc in ['mass', 'calc']:
+        for set_type in ['train', 'test']:
+            rows = []
+            for i in range(cases):
+                patient_id = f'P_{desc}{set_type}{i // 2:05d}'
+                side = 'LEFT' if i % 4 < 2 else 'RIGHT'
+                view = 'CC' if i % 2 == 0 else 'MLO'
+                name = f'{desc.capitalize()}-{"Training" if set_type == "train" else "Test"}_{patient_id}_{side}_{view}'
+                image_dir, image_path = add_series(name)
+                write_dicom(os.path.join(image_dir, '1-1.dcm'), make_mammogram(rng, shape, side == 'LEFT'),
+                            'MONOCHROME1' if i % 2 else 'MONOCHROME2')
+                n_files += 1
+                abnormalities = 2 if int(i * shared) != int((i + 1) * shared) else 1
+                for abnormality_id in range(1, abnormalities + 1):
+                    roi_dir, roi_path = add_series(f'{name}_{abnormality_id}')
+                    mask = make_mask(rng, shape)
+                    write_dicom(os.path.join(roi_dir, '1-1.dcm'), mask)
+                    n_files += 1
+                    if i % 2 == 0:
+                        # ROI series holding both the cropped image and the mask
+                        ys, xs = np.nonzero(mask)
+                        write_dicom(os.path.join(roi_dir, '1-2.dcm'),
+                                    rng.integers(0, 4000, size=(np.ptp(ys) + 1, np.ptp(xs) + 1), dtype=np.uint16))
+                        n_files += 1
+
+                    rows.append({
+                        'patient_id': patient_id,
+                        'breast density': 1 + i % 4,
+                        'left or right breast': side,
+                        'image view': view,
+                        'abnormality id': abnormality_id,
+                        'abnormality type': desc,
+                        'pathology': PATHOLOGIES[(i + abnormality_id - 1) % 3],
+                        'assessment': 3,
+                        'subtlety': 1 + i % 5,
+                        'image file path': f'{image_path}/000000.dcm',
+                        'cropped image file path': f'{roi_path}/000000.dcm',
+                        'ROI mask file path': f'{roi_path}/000001.dcm',
+                    })
+            pd.DataFrame(rows).to_csv(os.path.join(root, f'{desc}_case_description_{set_type}_set.csv'), index=False)
+    pd.DataFrame(metadata_rows).to_csv(os.path.join(root, 'metadata.csv'), index=False)
+    return n_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic CBIS-DDSM dataset generator")
+    parser.add_argument("root", type=str)
+    parser.add_argument("--cases", type=int, default=8, help="Mammograms per case description file")
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shared", type=float, default=0.25, help="Share of the mammograms with two abnormalities")
+    args = parser.parse_args()
+    n_files = make_cbis_tree(args.root, args.cases, (args.height, args.width), args.seed, args.shared)
+    print(f'{n_files} DICOM files written to {args.root}')
@@ -0,0 +1,74 @@
+"""Timing comparison of the ROI mask bounding box and loading against the previous implementations.
+
+Usage (from the repository root):
+    python -m benchmarks.mask_bench --height 4000 --width 3000
+"""
+import os
+import cv2
+import time
+import argparse
+import tempfile
+import numpy as np
+from benchmarks.fixtures import make_mask, write_dicom
+from src.utils.crop import component_bounds, mask_bounds
+from src.utils.dicom import load_dicom_image, load_dicom_mask_image
+
+
+def legacy_mask_bounds(mask):
+    """The argwhere implementation extract_patch used before mask_bounds"""
+    coords = np.argwhere(mask)
+    y_min, x_min = coords.min(axis=0)
+    y_max, x_max = coords.max(axis=0)
+    return y_min, y_max, x_min, x_max
+
+
+def bounding_rect_bounds(mask):
+    """The cv2.boundingRect implementation mask_bounds used for uint8 masks"""
+    x, y, w, h = cv2.boundingRect(mask)
+    return y, y + h - 1, x, x + w - 1
+
+
+def best_time(fn, *args, repeat: int = 5):
+    """Best wall time of several calls, with the result of the last one"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ROI mask benchmark")
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.height, args.width)
+    small = make_mask(rng, shape).astype(np.uint8)
+    # Large mass covering about a quarter of the image
+    large = np.zeros(shape, dtype=np.uint8)
+    large[shape[0] // 4:3 * shape[0] // 4, :shape[1] // 2] = 255
+    two_lesions = small | np.roll(small, shape[1] // 3, axis=1)
+
+    print(f'{shape[0]}x{shape[1]} masks, best of {args.repeat}')
+    for name, mask in [('small lesion', small), ('large mass', large)]:
+        legacy_time, legacy = best_time(legacy_mask_bounds, mask, repeat=args.repeat)
+        rect_time, rect_bounds = best_time(bounding_rect_bounds, mask, repeat=args.repeat)
+        any_time, bounds = best_time(mask_bounds, mask, repeat=args.repeat)
+        assert tuple(legacy) == tuple(rect_bounds) == tuple(bounds)
+        print(f'{name:14s} argwhere {legacy_time * 1e3:8.2f} ms | boundingRect {rect_time * 1e3:6.2f} ms '
+              f'({legacy_time / rect_time:.0f}x) | np.any {any_time * 1e3:6.2f} ms ({legacy_time / any_time:.0f}x)')
+    components_time, components = best_time(component_bounds, two_lesions, repeat=args.repeat)
+    print(f'{len(components)} components     {components_time * 1e3:8.2f} ms')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'mask.dcm')
+        write_dicom(path, small.astype(np.uint16) * 255)
+        normalized_time, normalized = best_time(load_dicom_image, path, repeat=args.repeat)
+        binary_time, binary = best_time(load_dicom_mask_image, path, repeat=args.repeat)
+        assert np.array_equal(normalized != 0, binary != 0)
+        print(f'mask loading   normalized {normalized_time * 1e3:8.2f} ms | binary {binary_time * 1e3:6.2f} ms '
+              f'({normalized_time / binary_time:.1f}x)')
@@ -0,0 +1,81 @@
+"""Timing comparison of the metadata correction against the previous row by row implementation.
+
+Usage (from the repository root):
+    python -m benchmarks.metadata_bench --rows 3500 --metadata_rows 12000
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from src.utils.metadata import (RENAMED_COLUMNS, build_metadata_index, correct_lesion_description,
+                                get_image_path_ids, normalize_and_format_path)
+
+
+def legacy_correct_lesion_description(df: pd.DataFrame, metadata_df: pd.DataFrame):
+    """The iterrows implementation correct_metadata_files used before the index join"""
+    df = df.copy()
+    for idx, row in df.iterrows():
+        for key in ['image_file_path', 'roi_mask_file_path', 'cropped_image_file_path']:
+            study_id, series_uid = get_image_path_ids(row, key)
+            meta = metadata_df[(metadata_df['Series UID'] == series_uid) & (
+                metadata_df['Study UID'] == study_id)]
+            df.loc[idx, key] = normalize_and_format_path(
+                meta['File Location'].values[0])
+    return df
+
+
+def make_synthetic_tables(n_rows: int, n_metadata_rows: int, seed: int = 0):
+    """Build a case description table and a metadata table with CBIS-like paths
+
+    Args:
+        n_rows (int): number of case description rows
+        n_metadata_rows (int): number of metadata rows, at least 3 * n_rows
+        seed (int): random seed
+
+    Returns:
+        tuple: (case description dataframe, metadata dataframe)
+    """
+    rng = np.random.default_rng(seed)
+    n_metadata_rows = max(n_metadata_rows, 3 * n_rows)
+    study = np.array([f'1.3.6.1.4.1.9590.100.1.2.{i}' for i in rng.permutation(n_metadata_rows)])
+    series = np.array([f'1.3.6.1.4.1.9590.100.1.2.{i + n_metadata_rows}'
+                      for i in rng.permutation(n_metadata_rows)])
+    names = np.array([f'Mass-Training_P_{i:05d}_LEFT_CC' for i in range(n_metadata_rows)])
+    metadata_df = pd.DataFrame({
+        'Series UID': series,
+        'Study UID': study,
+        'File Location': [f'.\\CBIS-DDSM\\{n}\\{st}\\{i % 9 + 1}-{se[-5:]}'
+                          for i, (n, st, se) in enumerate(zip(names, study, series))],
+    })
+
+    picks = rng.choice(n_metadata_rows, size=(3, n_rows), replace=False)
+    df = pd.DataFrame({
+        'patient_id': [f'P_{i:05d}' for i in range(n_rows)],
+        'image file path': [f'{names[i]}/{study[i]}/{series[i]}/000000.dcm' for i in picks[0]],
+        'cropped image file path': [f'{names[i]}/{study[i]}/{series[i]}/000000.dcm' for i in picks[1]],
+        'ROI mask file path': [f'{names[i]}/{study[i]}/{series[i]}/000001.dcm' for i in picks[2]],
+    }).rename(columns=RENAMED_COLUMNS)
+    return df, metadata_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Metadata correction benchmark")
+    parser.add_argument("--rows", type=int, default=3500)
+    parser.add_argument("--metadata_rows", type=int, default=12000)
+    args = parser.parse_args()
+
+    df, metadata_df = make_synthetic_tables(args.rows, args.metadata_rows)
+
+    start = time.perf_counter()
+    metadata_index = build_metadata_index(metadata_df)
+    corrected, unmatched = correct_lesion_description(df, metadata_index)
+    indexed_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy = legacy_correct_lesion_description(df, metadata_df)
+    legacy_time = time.perf_counter() - start
+
+    assert not unmatched.any() and corrected.equals(legacy)
+    print(f'{args.rows} rows, {len(metadata_df)} metadata rows')
+    print(f'iterrows : {legacy_time:.3f}s')
+    print(f'indexed  : {indexed_time:.3f}s ({legacy_time / indexed_time:.0f}x faster)')
@@ -0,0 +1,169 @@
+"""Stage by stage timing of the preparation pipeline on a synthetic CBIS-DDSM dataset.
+
+Each stage is timed on its own, in the main process, then the whole preparation is
+run with the worker pool. Results are printed and saved as JSON so that two commits
+can be compared with --baseline.
+
+Usage (from the repository root):
+    python -m benchmarks.pipeline_bench --cases 16 --height 2048 --width 1536 --output bench.json
+    python -m benchmarks.pipeline_bench --cases 16 --height 2048 --width 1536 --baseline bench.json
+"""
+import os
+import cv2
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import platform
+import subprocess
+from glob import glob
+from benchmarks.fixtures import make_cbis_tree
+from src.tasks.pipeline import prepare_datasets
+from src.tasks.registry import make_variants
+from src.utils.augmentations import make_augmentation
+from src.utils.crop import extract_patch
+from src.utils.dicom import load_dicom_image, load_dicom_mask
+from src.utils.dicom_index import load_dicom_index
+from src.utils.metadata import correct_metadata_files
+from src.utils.pool import WorkerPool
+from src.utils.preprocessing import clahe
+from src.utils.records import read_case_records, resolve_dicom_files
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its finished children, in MB"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'self': own / 1024, 'children': children / 1024}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageTimer:
+    """Accumulate the time spent and the number of images processed by each stage"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, name: str, fn, *args, images: int = 1):
+        start = time.perf_counter()
+        result = fn(*args)
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'images': 0})
+        stage['seconds'] += time.perf_counter() - start
+        stage['images'] += images
+        return result
+
+    def report(self):
+        for stage in self.stages.values():
+            stage['images_per_s'] = stage['images'] / stage['seconds'] if stage['seconds'] > 0 else None
+        return self.stages
+
+
+def bench_stages(data_dir: str, out_dir: str, img_size: int, patch_padding: int, aug_ratio: int, pool: WorkerPool):
+    """Time each preparation stage separately on the rows of the corrected csv files"""
+    timer = StageTimer()
+    timer.time('correct_metadata_files', correct_metadata_files, data_dir, images=4)
+
+    records = [r for csv in sorted(glob(os.path.join(data_dir, '*corrected.csv'))) for r in read_case_records(csv)]
+    dicom_index = load_dicom_index(data_dir, [p for r in records for p in (r.image_file_path, r.roi_mask_file_path)], pool)
+    records = resolve_dicom_files(records, data_dir, dicom_index)
+
+    split_dir = os.path.join(out_dir, 'stages', 'train')
+    os.makedirs(os.path.join(split_dir, 'roi'), exist_ok=True)
+    for record in records:
+        image = timer.time('load_dicom_image', load_dicom_image, record.image_file)
+        mask = timer.time('load_dicom_mask', load_dicom_mask, record.mask_files, image.shape, None, record.mask_shapes)
+        patch = timer.time('extract_patch', extract_patch, image, mask, patch_padding)
+        timer.time('clahe', lambda img: cv2.merge((img, clahe(img, 1.0), clahe(img, 2.0))), image)
+        timer.time('resize_write', lambda img: cv2.imwrite(
+            os.path.join(split_dir, 'roi', f'{record.name}_{record.abnormality_type}.png'),
+            cv2.resize(img, (img_size, img_size), interpolation=cv2.INTER_LINEAR)), patch)
+
+    if aug_ratio > 0:
+        timer.time('make_augmentation', make_augmentation, split_dir, aug_ratio, pool,
+                   images=len(records) * aug_ratio)
+    return timer.report()
+
+
+def bench_end_to_end(data_dir: str, out_dir: str, tasks: list, img_size: int, patch_padding: int, pool: WorkerPool):
+    """Time a full preparation of the given tasks, as run.py does it"""
+    variants = make_variants(os.path.join(out_dir, 'prepared'), tasks, [img_size], [patch_padding])
+    start = time.perf_counter()
+    prepare_datasets(data_dir, variants, None, pool)
+    seconds = time.perf_counter() - start
+    images = sum(len(glob(os.path.join(v.task_dir, '*', '*', '*.png'))) for v in variants)
+    return {'tasks': tasks, 'seconds': seconds, 'images': images,
+            'images_per_s': images / seconds if seconds > 0 else None}
+
+
+def compare(results: dict, baseline: dict):
+    """Print the speedup of each stage against a previous result file"""
+    print(f"\nAgainst {baseline.get('commit')}:")
+    for name, stage in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous and stage['seconds'] > 0:
+            print(f"  {name:24s} {previous['seconds'] / stage['seconds']:6.2f}x")
+    previous = baseline.get('end_to_end')
+    if previous and results['end_to_end']['seconds'] > 0:
+        print(f"  {'end_to_end':24s} {previous['seconds'] / results['end_to_end']['seconds']:6.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preparation pipeline benchmark")
+    parser.add_argument("--cases", type=int, default=8, help="Mammograms per case description file")
+    parser.add_argument("--height", type=int, default=1024, help="Height of the synthetic mammograms")
+    parser.add_argument("--width", type=int, default=768, help="Width of the synthetic mammograms")
+    parser.add_argument("--img_size", type=int, default=256)
+    parser.add_argument("--patch_padding", type=int, default=100)
+    parser.add_argument("--aug_ratio", type=int, default=2)
+    parser.add_argument("--task", nargs='+', type=str, default=['roi-severity', 'scan'])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="Folder of the synthetic dataset and outputs, a temporary one is used if not given")
+    parser.add_argument("--output", type=str, default=None, help="JSON result file")
+    parser.add_argument("--baseline", type=str, default=None, help="Previous JSON result file to compare with")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='cbis_bench_')
+    data_dir, out_dir = os.path.join(work_dir, 'cbis'), os.path.join(work_dir, 'out')
+    try:
+        if not os.path.exists(os.path.join(data_dir, 'metadata.csv')):
+            make_cbis_tree(data_dir, args.cases, (args.height, args.width))
+        # Outputs and indexes of a previous run are not reused
+        shutil.rmtree(out_dir, ignore_errors=True)
+        for path in glob(os.path.join(data_dir, '*corrected.csv')) + glob(os.path.join(data_dir, 'dicom_index.csv')):
+            os.remove(path)
+
+        with WorkerPool(args.workers) as pool:
+            stages = bench_stages(data_dir, out_dir, args.img_size, args.patch_padding, args.aug_ratio, pool)
+            stages_rss = peak_rss_mb()
+            end_to_end = bench_end_to_end(data_dir, out_dir, args.task, args.img_size, args.patch_padding, pool)
+
+        results = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'config': {k: v for k, v in vars(args).items() if k not in ('work_dir', 'output', 'baseline')},
+            'stages': stages,
+            'stages_peak_rss_mb': stages_rss,
+            'end_to_end': end_to_end,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
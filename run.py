@@ -1,25 +1,42 @@
 import argparse
 import logging
-import os
-from src.utils.metadata import correct_metadata_files
-from src.tasks.lesion import prepare_lesion_dataset, prepare_lesion_severity_dataset
-from src.tasks.roi import prepare_roi_severity_dataset
+from src.tasks.preparation import Pipeline, PreparationConfig
+from src.tasks.registry import DUPLICATE_SCAN_POLICIES, TASKS
+from src.utils.formats import IMAGE_FORMATS, SHARD_FORMATS
 from src.utils.print import read_poem
-from src.utils.augmentations import make_augmentation
-from glob import glob
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="CBIS-DDSM data preparation")
     parser.add_argument("--data_dir", type=str, required=True)
     parser.add_argument("--out_dir", type=str, default='./data')
-    parser.add_argument("--img_size", type=int, default=256)
+    parser.add_argument("--img_size", type=int, nargs='+', default=[256])
     parser.add_argument("--synthetize", action='store_true')
-    parser.add_argument("--patch_padding", type=int, default=100)
+    parser.add_argument("--patch_padding", type=int, nargs='+', default=[100])
     parser.add_argument("--aug_ratio", type=int, default=8)
-    parser.add_argument("--task", type=str, default='roi-severity', choices=['scan', 'scan-severity',
-                                                                             'scan-mass-severity', 'scan-calc-severity',
-                                                                             'roi-severity', 'roi-mass-severity',
-                                                                             'roi-calc-severity'])
+    parser.add_argument("--aug_seed", type=int, default=0)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_size", type=float, default=50.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--max_inflight", type=int, default=None)
+    parser.add_argument("--output_format", type=str, default='png', choices=[*IMAGE_FORMATS, *SHARD_FORMATS])
+    parser.add_argument("--png_compression", type=int, default=None, choices=range(10),
+                        help="zlib level of the png files, 0 is the fastest and 9 the smallest")
+    parser.add_argument("--shard_size", type=int, default=1000)
+    parser.add_argument("--early_downsample", action='store_true')
+    parser.add_argument("--crop_breast", action='store_true')
+    parser.add_argument("--duplicate_scans", type=str, default='copy', choices=DUPLICATE_SCAN_POLICIES,
+                        help="How the scans of the rows sharing a mammogram are saved")
+    parser.add_argument("--folds", type=int, default=None,
+                        help="Number of patient grouped cross validation folds of the train split")
+    parser.add_argument("--fold_seed", type=int, default=0)
+    parser.add_argument("--profile", action='store_true',
+                        help="Print per stage timings and save them to out_dir/profile.json")
+    parser.add_argument("--cprofile_dir", type=str, default=None,
+                        help="Dump the cProfile statistics of each worker in this folder, implies --profile")
+    parser.add_argument("--task", type=str, nargs='+', default=['roi-severity'], choices=list(TASKS))
+    parser.add_argument("--dry_run", action='store_true',
+                        help="Print the number of outputs of each task and their estimated size, then exit")
     args = parser.parse_args()
     parser.set_defaults(synthetize=False)
 
@@ -29,42 +46,22 @@ if __name__ == "__main__":
         format=f'%(asctime)s - {logging_message} - %(levelname)s - %(message)s'
     )
 
-    logging.info('Running CBIS-DDSM dataset preparation')
-    logging.info(f'Creating dataset for {args.task} task')
-    if len(glob(args.data_dir + '/*corrected.csv')) != 4:
-        logging.info('Corrected csv files not found. Creating ...')
-        correct_metadata_files(args.data_dir)
-        logging.info(f'Corrected csv files saved at {args.data_dir}')
-    os.makedirs(os.path.join(args.out_dir, args.task, 'train'), exist_ok=True)
-    os.makedirs(os.path.join(args.out_dir, args.task, 'test'), exist_ok=True)
+    config = PreparationConfig(
+        args.data_dir, args.out_dir, tasks=args.task, img_sizes=args.img_size, patch_paddings=args.patch_padding,
+        synthetize=args.synthetize, aug_ratio=args.aug_ratio, aug_seed=args.aug_seed, cache_dir=args.cache_dir,
+        cache_size=args.cache_size, workers=args.workers, chunksize=args.chunksize, max_inflight=args.max_inflight,
+        output_format=args.output_format, png_compression=args.png_compression, shard_size=args.shard_size,
+        early_downsample=args.early_downsample, crop_breast=args.crop_breast, duplicate_scans=args.duplicate_scans,
+        folds=args.folds, fold_seed=args.fold_seed, profile=args.profile, cprofile_dir=args.cprofile_dir)
+    pipeline = Pipeline(config)
 
-    if args.task == 'scan':
-        prepare_lesion_dataset(
-            args.data_dir, args.out_dir, args.img_size, args.task, synthetize=args.synthetize)
-    elif args.task == 'scan-severity':
-        prepare_lesion_severity_dataset(
-            args.data_dir, args.out_dir, args.img_size, args.task, synthetize=args.synthetize)
-    elif args.task == 'scan-mass-severity':
-        prepare_lesion_severity_dataset(
-            args.data_dir, args.out_dir, args.img_size, args.task, 'mass', synthetize=args.synthetize)
-    elif args.task == 'scan-calc-severity':
-        prepare_lesion_severity_dataset(
-            args.data_dir, args.out_dir, args.img_size, args.task, 'calc', synthetize=args.synthetize)
-    elif args.task == 'roi-severity':
-        prepare_roi_severity_dataset(
-            args.data_dir, args.out_dir, args.img_size, args.task, patch_padding=args.patch_padding, synthetize=args.synthetize)
-    elif args.task == 'roi-mass-severity':
-        prepare_roi_severity_dataset(
-            args.data_dir, args.out_dir, args.img_size, args.task, roi_type='mass', patch_padding=args.patch_padding, synthetize=args.synthetize)
-    elif args.task == 'roi-calc-severity':
-        prepare_roi_severity_dataset(
-            args.data_dir, args.out_dir, args.img_size, args.task, roi_type='calc', patch_padding=args.patch_padding, synthetize=args.synthetize)
+    if args.dry_run:
+        for task_dir, plan in pipeline.plan().items():
+            print(f"{task_dir:40s} {plan['train']:7d} train {plan['test']:7d} test {plan['augmented']:8d} augmented "
+                  f"{plan['existing']:7d} existing {plan['estimated_bytes'] / 1024 ** 2:10.1f} MB")
+    else:
+        logging.info('Running CBIS-DDSM dataset preparation')
+        pipeline.run()
 
-    if args.aug_ratio > 0:
-        synthetize_str = "_synthetized" if args.synthetize else ""
-        task = f"{args.task}{synthetize_str}"
-        make_augmentation(os.path.join(
-            args.out_dir, task, 'train'), args.aug_ratio)
-
-    logging.info('You made it. Have a piece of a french poem :')
-    read_poem()
+        logging.info('You made it. Have a piece of a french poem :')
+        read_poem()
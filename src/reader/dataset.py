@@ -0,0 +1,198 @@
+import os
+import numpy as np
+import pandas as pd
+from glob import glob
+from collections import OrderedDict
+from src.utils.codecs import read_image
+from src.utils.formats import is_image_file
+from src.utils.samples import SAMPLES_NAME, read_sample_table
+from src.utils.shards import INDEX_NAME, load_shard_sample, read_shard_index
+
+
+READER_INDEX_NAME = 'reader_index.npz'
+PACKED_NAME = 'packed.u8'
+SPLITS = ('train', 'test')
+
+
+def _folder_mtimes(task_dir: str):
+    """Modification times of the folders and shard index files of a prepared task.
+    Adding or removing an image changes the mtime of its label folder, so these are
+    enough to know whether a cached index is still valid without listing the images."""
+    mtimes = {}
+    samples_path = os.path.join(task_dir, SAMPLES_NAME)
+    if os.path.exists(samples_path):
+        mtimes[SAMPLES_NAME] = os.stat(samples_path).st_mtime_ns
+    for split in SPLITS:
+        split_dir = os.path.join(task_dir, split)
+        if not os.path.isdir(split_dir):
+            continue
+        mtimes[split] = os.stat(split_dir).st_mtime_ns
+        shard_index = os.path.join(split_dir, INDEX_NAME)
+        if os.path.exists(shard_index):
+            mtimes[os.path.join(split, INDEX_NAME)] = os.stat(shard_index).st_mtime_ns
+            continue
+        for entry in os.scandir(split_dir):
+            if entry.is_dir():
+                mtimes[os.path.join(split, entry.name)] = entry.stat().st_mtime_ns
+    return mtimes
+
+
+def build_index(task_dir: str):
+    """List the samples of a prepared task, image folders or shards
+
+    Args:
+        task_dir (str): Folder of the prepared task
+
+    Returns:
+        dict: numpy arrays describing the samples, see PreparedDataset
+    """
+    paths, labels, splits, offsets, sizes, outputs = [], [], [], [], [], []
+    for split_id, split in enumerate(SPLITS):
+        split_dir = os.path.join(task_dir, split)
+        if os.path.exists(os.path.join(split_dir, INDEX_NAME)):
+            index = read_shard_index(split_dir)
+            paths.extend(os.path.join(split, shard) for shard in index['shard'])
+            labels.extend(index['label'])
+            offsets.extend(index['offset'])
+            sizes.extend(index['size'])
+            outputs.extend(f'{split}/{key}' for key in index['key'])
+        else:
+            for path in sorted(filter(is_image_file, glob(os.path.join(split_dir, '*', '*')))):
+                paths.append(os.path.relpath(path, task_dir))
+                labels.append(os.path.basename(os.path.dirname(path)))
+                offsets.append(-1)
+                sizes.append(-1)
+                outputs.append(paths[-1])
+        splits.extend([split_id] * (len(paths) - len(splits)))
+
+    # Cross validation fold of each sample, from the sample table of the task
+    table = read_sample_table(task_dir)
+    folds = [-1] * len(outputs) if table is None else \
+        pd.Series(outputs).map(table.set_index('output')['fold']).fillna(-1).astype(int).tolist()
+
+    classes, label_ids = np.unique(np.array(labels, dtype=str), return_inverse=True)
+    return {
+        'paths': np.array(paths, dtype=bytes),
+        'labels': label_ids.astype(np.int16),
+        'classes': classes,
+        'splits': np.array(splits, dtype=np.int8),
+        'offsets': np.array(offsets, dtype=np.int64),
+        'sizes': np.array(sizes, dtype=np.int64),
+        'folds': np.array(folds, dtype=np.int8),
+        'mtimes': np.array(list(_folder_mtimes(task_dir).items()), dtype=str),
+    }
+
+
+def load_index(task_dir: str):
+    """Load the cached index of a prepared task, rebuilding it when its folders changed"""
+    index_path = os.path.join(task_dir, READER_INDEX_NAME)
+    if os.path.exists(index_path):
+        with np.load(index_path) as data:
+            index = dict(data)
+        cached_mtimes = {k: v for k, v in index['mtimes']}
+        # Indexes saved before the fold column existed are rebuilt
+        if cached_mtimes == {k: str(v) for k, v in _folder_mtimes(task_dir).items()} and 'folds' in index:
+            return index
+    index = build_index(task_dir)
+    np.savez(index_path, **index)
+    return index
+
+
+class PreparedDataset:
+    """Lazy, framework independent, reader of a prepared task folder.
+
+    The list of samples is kept as numpy arrays and cached in ``reader_index.npz``,
+    so that opening a large prepared task does not walk its folders again. Images are
+    decoded on access and the most recently used ones are kept in memory. Once packed
+    with ``pack``, all the images of the task are read from a single memory mapped file.
+    Cross validation folds are read from the sample table of the task, see ``--folds``.
+
+    Args:
+        task_dir (str): Folder of the prepared task, e.g. out_dir/roi-severity
+        split (str): 'train', 'test' or None for both
+        cache_size (int): Number of decoded images kept in memory
+        folds (list): Folds of the samples to keep, None to keep every sample of the split
+    """
+
+    def __init__(self, task_dir: str, split: str = 'train', cache_size: int = 256, folds: list = None):
+        self.task_dir = task_dir
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._index = load_index(task_dir)
+        self.classes = [str(c) for c in self._index['classes']]
+        selected = np.ones(len(self._index['paths']), dtype=bool) if split is None \
+            else self._index['splits'] == SPLITS.index(split)
+        if folds is not None:
+            selected &= np.isin(self._index['folds'], folds)
+        self._ids = np.flatnonzero(selected)
+        self.labels = self._index['labels'][self._ids]
+        self.folds = self._index['folds'][self._ids]
+        self._packed = None
+        if 'packed_offsets' in self._index and os.path.exists(os.path.join(task_dir, PACKED_NAME)):
+            self._packed = np.memmap(os.path.join(task_dir, PACKED_NAME), dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _load(self, i: int):
+        if self._packed is not None:
+            offset = self._index['packed_offsets'][i]
+            shape = tuple(s for s in self._index['packed_shapes'][i] if s > 0)
+            return self._packed[offset:offset + np.prod(shape)].reshape(shape)
+        path = os.path.join(self.task_dir, self._index['paths'][i].decode())
+        if self._index['offsets'][i] < 0:
+            return read_image(path)
+        split_dir, shard = os.path.split(path)
+        return load_shard_sample(split_dir, shard, self._index['offsets'][i], self._index['sizes'][i])
+
+    def get_image(self, idx: int):
+        """Image of a sample, served from the in-memory cache when possible"""
+        i = self._ids[idx]
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        image = self._load(i)
+        if self.cache_size > 0:
+            self._cache[i] = image
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return image
+
+    def __getitem__(self, idx: int):
+        return self.get_image(idx), int(self.labels[idx])
+
+    def get_batch(self, indices):
+        """Load several samples at once
+
+        Args:
+            indices (list): sample indices, the images must share the same shape
+
+        Returns:
+            tuple: (contiguous uint8 array of shape (len(indices), ...), int16 label array)
+        """
+        images = [self.get_image(idx) for idx in indices]
+        batch = np.empty((len(images), *images[0].shape), dtype=np.uint8)
+        for b, image in enumerate(images):
+            if image.shape != images[0].shape:
+                raise ValueError(f'Sample {indices[b]} has shape {image.shape} instead of {images[0].shape}')
+            batch[b] = image
+        return batch, self.labels[np.asarray(indices)]
+
+    def pack(self):
+        """Copy every image of the task, both splits, into a single file read through a memory map"""
+        self._packed = None
+        n = len(self._index['paths'])
+        offsets = np.zeros(n, dtype=np.int64)
+        shapes = np.zeros((n, 3), dtype=np.int32)
+        tmp_path = os.path.join(self.task_dir, PACKED_NAME + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            for i in range(n):
+                image = np.ascontiguousarray(self._load(i))
+                offsets[i] = f.tell()
+                shapes[i, :image.ndim] = image.shape
+                f.write(image.tobytes())
+        os.replace(tmp_path, os.path.join(self.task_dir, PACKED_NAME))
+        self._index['packed_offsets'] = offsets
+        self._index['packed_shapes'] = shapes
+        np.savez(os.path.join(self.task_dir, READER_INDEX_NAME), **self._index)
+        self._packed = np.memmap(os.path.join(self.task_dir, PACKED_NAME), dtype=np.uint8, mode='r')
@@ -1,41 +1,106 @@
-from glob import glob
-import logging
 import os
-import cv2
-import shutil
-from tqdm import tqdm
-from src.utils.dicom import load_dicom_image
-import pandas as pd
-from concurrent.futures import ProcessPoolExecutor
-from src.utils.preprocessing import clahe
-
-
-def prepare_lesion_row(row, data_dir: str, out_folder: str, img_size: int, severity: bool = False, synthetize: bool = False):
-    image_path = os.path.join(
-        data_dir, row['image_file_path'])
-    image = glob(image_path + '/*.dcm')[0]
-
-    original_image = load_dicom_image(image)
-    if synthetize:
-        original_image = cv2.merge((original_image, clahe(
-            original_image, 1.0), clahe(original_image, 2.0)))
-    resized_image = cv2.resize(
-        original_image,
-        (img_size, img_size),
-        interpolation=cv2.INTER_LINEAR,
-    )
+from src.utils.formats import IMAGE_FORMATS, image_extension
+from src.utils.loading import RowImages
+from src.utils.manifest import file_signature, is_up_to_date, write_output
+from src.utils.profiling import add_bytes, stage
+from src.utils.streaming import write_file
 
+
+# Result of prepare_duplicate_lesion_row for the rows merged in the scan of another row,
+# as opposed to None for the rows which failed
+MERGED = 'merged'
+
+
+def lesion_output_path(row, out_folder: str, severity: bool = False, extension: str = '.png'):
     if not severity:
-        output_image_path = os.path.join(out_folder,
-                                         "{}.png".format(row.name))
-    else:
-        sev = 'BENIGN' if row['pathology'] == 'BENIGN_WITHOUT_CALLBACK' else row['pathology']
-        output_image_path = os.path.join(
-            out_folder, '{}_{}'.format(row['abnormality type'], sev), "{}.png".format(row.name))
-    cv2.imwrite(output_image_path, resized_image)
+        return os.path.join(out_folder, "{}{}".format(row.name, extension))
+    sev = 'BENIGN' if row['pathology'] == 'BENIGN_WITHOUT_CALLBACK' else row['pathology']
+    return os.path.join(
+        out_folder, '{}_{}'.format(row['abnormality type'], sev), "{}{}".format(row.name, extension))
+
+
+def prepare_lesion_row(row, data_dir: str, out_folder: str, img_size: int, severity: bool = False, synthetize: bool = False, cache=None, previous: dict = None, images: RowImages = None, output_format: str = 'png', crop_breast: bool = False, defer_write: bool = False, png_compression: int = None):
+    if images is None:
+        images = RowImages(row, data_dir, cache)
+
+    output_image_path = lesion_output_path(row, out_folder, severity, image_extension(output_format))
+    inputs = file_signature([images.image_file])
+    params = {'img_size': img_size, 'severity': severity, 'synthetize': synthetize}
+    if images.target_size is not None:
+        # The downsampling depends on the largest image size of the variants sharing the mammogram
+        params['early_downsample'] = images.target_size
+    if crop_breast:
+        params['crop_breast'] = True
+    if output_format == 'png' and png_compression is not None:
+        params['png_compression'] = png_compression
+    if is_up_to_date(previous, output_image_path, inputs, params):
+        return output_image_path, previous
+
+    if crop_breast and previous is not None and 'breast_box' in previous and previous['inputs'] == inputs \
+            and previous['params'].get('early_downsample') == params.get('early_downsample') \
+            and 'breast_box' not in images.mammogram.__dict__:
+        # Breast box found by a previous run on the same image
+        images.mammogram.breast_box = tuple(previous['breast_box'])
+
+    resized_image = images.resized(img_size, synthetize, crop_breast)
+    output_image_path, entry = write_output(output_image_path, resized_image, inputs, params, output_format, defer_write,
+                                            png_compression)
+    if crop_breast:
+        entry['breast_box'] = list(images.breast_box)
+    return output_image_path, entry
+
 
+def prepare_duplicate_lesion_row(row, out_folder: str, severity: bool, primary: tuple, previous: dict = None, output_format: str = 'png', duplicate_scans: str = 'copy', defer_write: bool = False):
+    """Scan output of a row whose mammogram was already prepared for another row of the same variant,
+    a mammogram holding several abnormalities being described by several rows.
 
-def prepare_lesion_dataset(data_dir: str, out_dir: str, img_size: int, task: str, synthetize: bool = False):
+    Args:
+        row (CaseRecord): case description row
+        out_folder (str): Path to save the output
+        severity (bool): Whether to create classes for pathologies or not
+        primary (tuple): (output path, manifest entry) of the other row, the entry holding the encoded
+            image as 'data' when it was just prepared
+        previous (dict): previous manifest entry of the output
+        output_format (str): one of IMAGE_FORMATS, or one of SHARD_FORMATS to pack the image of the other row
+        duplicate_scans (str): 'copy' to save the same image file again, 'link' to hard link the file of
+            the other row, which must be written, or 'merge' for no output, the row only being listed
+            in the labels of the other row's sample
+        defer_write (bool): Whether to return the encoded image in the entry instead of writing it
+
+    Returns:
+        tuple: (output path, manifest entry), MERGED with the 'merge' policy
+    """
+    if duplicate_scans == 'merge':
+        return MERGED
+    primary_path, primary_entry = primary
+    output_image_path = lesion_output_path(row, out_folder, severity, image_extension(output_format))
+    if output_format not in IMAGE_FORMATS:
+        return output_image_path, primary_entry
+    entry = {key: value for key, value in primary_entry.items() if key not in ('data', 'output')}
+    if is_up_to_date(previous, output_image_path, entry['inputs'], entry['params']) \
+            and previous['hash'] == entry['hash']:
+        return output_image_path, previous
+
+    if duplicate_scans == 'link':
+        with stage('write'):
+            if os.path.lexists(output_image_path):
+                os.remove(output_image_path)
+            os.link(primary_path, output_image_path)
+        return output_image_path, entry
+    data = primary_entry.get('data')
+    if data is None:
+        # The image of the other row was up to date, its file is read instead of being encoded again
+        with stage('read'):
+            with open(primary_path, 'rb') as f:
+                data = f.read()
+        add_bytes(read=len(data))
+    if defer_write:
+        return output_image_path, dict(entry, data=data)
+    write_file(output_image_path, data)
+    return output_image_path, entry
+
+
+def prepare_lesion_dataset(data_dir: str, out_dir: str, img_size: int, task: str, synthetize: bool = False, cache=None):
     """Prepare the CBIS dataset for lesion specific classification
 
     Args:
@@ -43,36 +108,16 @@ def prepare_lesion_dataset(data_dir: str, out_dir: str, img_size: int, task: str
         out_dir (str): Path to save the prepared cbis dataset
         img_size (int): New image size
         severity (bool): Whether to create classes for pathologies or not
+        cache (DicomCache): Optional decoded image cache shared across runs
     """
-    shutil.rmtree(os.path.join(
-        out_dir, task, "_synthetized" if synthetize else ""), ignore_errors=True)
-    for csv_data_file in glob(data_dir + '/*corrected.csv'):
-        logging.info(f'Saving images defined in {csv_data_file}')
-        data_type = 'train' if 'train' in csv_data_file else 'test'
-        df = pd.read_csv(csv_data_file)
-        cls = df['abnormality type'].iloc[0]
-        syn_str = 'synthetized' if synthetize else ''
-        out_folder = os.path.join(out_dir, task + syn_str,
-                                  data_type, cls)
-        os.makedirs(out_folder, exist_ok=True)
-
-        with ProcessPoolExecutor() as executor:
-            list(
-                tqdm(
-                    executor.map(
-                        prepare_lesion_row,
-                        [row for _, row in df.iterrows()],
-                        [data_dir] * len(df),
-                        [out_folder] * len(df),
-                        [img_size] * len(df),
-                        [synthetize] * len(df)
-                    ),
-                    total=len(df),
-                )
-            )
-
-
-def prepare_lesion_severity_dataset(data_dir: str, out_dir: str, img_size: int, task: str, lesion_type: str = None, synthetize: bool = False):
+    from src.tasks.pipeline import prepare_datasets
+    from src.tasks.registry import Variant
+    syn_str = '_synthetized' if synthetize else ''
+    prepare_datasets(data_dir, [Variant(os.path.join(out_dir, task + syn_str), 'scan', False, None,
+                                        img_size, synthetize=synthetize)], cache)
+
+
+def prepare_lesion_severity_dataset(data_dir: str, out_dir: str, img_size: int, task: str, lesion_type: str = None, synthetize: bool = False, cache=None):
     """Prepare the CBIS dataset for lesion severity specific classification
 
     Args:
@@ -80,35 +125,10 @@ def prepare_lesion_severity_dataset(data_dir: str, out_dir: str, img_size: int,
         out_dir (str): Path to save the prepared cbis dataset
         img_size (int): New image size
         severity (bool): Whether to create classes for pathologies or not
+        cache (DicomCache): Optional decoded image cache shared across runs
     """
-    shutil.rmtree(os.path.join(
-        out_dir, task, "_synthetized" if synthetize else ""), ignore_errors=True)
-    csv_file_list = glob(data_dir + '/*corrected.csv') if not lesion_type else glob(
-        data_dir + f'/*{lesion_type}*corrected.csv')
-    for csv_data_file in csv_file_list:
-        logging.info(f'Saving images defined in {csv_data_file}')
-        data_type = 'train' if 'train' in csv_data_file else 'test'
-        df = pd.read_csv(csv_data_file)
-        cls = df['abnormality type'].iloc[0]
-        pathologies = ['BENIGN', 'MALIGNANT']
-        syn_str = '_synthetized' if synthetize else ''
-        out_folder = os.path.join(out_dir, task + syn_str,
-                                  data_type)
-        for i in pathologies:
-            os.makedirs(os.path.join(out_folder, f'{cls}_{i}'), exist_ok=True)
-
-        with ProcessPoolExecutor() as executor:
-            list(
-                tqdm(
-                    executor.map(
-                        prepare_lesion_row,
-                        [row for _, row in df.iterrows()],
-                        [data_dir] * len(df),
-                        [out_folder] * len(df),
-                        [img_size] * len(df),
-                        [True] * len(df),
-                        [synthetize] * len(df)
-                    ),
-                    total=len(df),
-                )
-            )
+    from src.tasks.pipeline import prepare_datasets
+    from src.tasks.registry import Variant
+    syn_str = '_synthetized' if synthetize else ''
+    prepare_datasets(data_dir, [Variant(os.path.join(out_dir, task + syn_str), 'scan', True, lesion_type,
+                                        img_size, synthetize=synthetize)], cache)
@@ -0,0 +1,261 @@
+import os
+import shutil
+import logging
+from glob import glob
+from tqdm import tqdm
+from itertools import repeat
+from functools import partial
+from src.utils.formats import IMAGE_FORMATS
+from src.utils.loading import MammogramImages, RowImages
+from src.utils.manifest import Manifest
+from src.utils.pool import WorkerPool
+from src.utils.profiling import stage
+from src.utils.records import read_case_records, resolve_dicom_files
+from src.utils.samples import assign_folds, sample_row, write_sample_table
+from src.utils.dicom_index import load_dicom_index
+from src.utils.shards import get_shard_writer
+from src.utils.streaming import FilePrefetcher, OutputWriter, write_file
+from src.tasks.lesion import MERGED, prepare_duplicate_lesion_row, prepare_lesion_row
+from src.tasks.registry import Variant
+from src.tasks.roi import prepare_roi_severity_row
+
+
+def prepare_rows(rows: list, data_dir: str, outputs: list, cache=None, early_downsample: bool = False, defer_write: bool = False):
+    """Produce every output of the case description rows of a mammogram from a single load of the image.
+    The mammogram is decoded, and its CLAHE lookup tables computed, once for all its rows. Scan
+    outputs are only prepared for the first row, the outputs of the other rows following the
+    duplicate_scans policy of their variant, see prepare_duplicate_lesion_row.
+
+    Args:
+        rows (list): CaseRecord of the rows sharing the mammogram
+        data_dir (str): Path to original cbis dataset
+        outputs (list): for each row, (variant, output folder, previous manifest entry) tuples
+        cache (DicomCache): Optional decoded image cache
+        early_downsample (bool): Whether to downsample the mammogram right after decoding
+            when the rows only have scan outputs
+        defer_write (bool): Whether to return the encoded image files instead of writing them
+
+    Returns:
+        list: for each row, (output path, manifest entry) for each output, None for failed ones and
+            MERGED for merged ones
+    """
+    target_size = None
+    row_variants = [variant for row_outputs in outputs for variant, _, _ in row_outputs]
+    if early_downsample and all(variant.family == 'scan' for variant in row_variants):
+        target_size = max(variant.img_size for variant in row_variants)
+    mammogram = MammogramImages(rows[0], data_dir, cache, target_size)
+    # Scan output of the first row of each variant, with its encoded image when it is copied
+    primaries = {}
+    all_results = []
+    for row, row_outputs in zip(rows, outputs):
+        images = RowImages(row, data_dir, cache, mammogram=mammogram)
+        results = []
+        for variant, out_folder, previous in row_outputs:
+            if variant.family == 'roi':
+                results.append(prepare_roi_severity_row(
+                    row, data_dir, out_folder, img_size=variant.img_size, patch_padding=variant.patch_padding,
+                    synthetize=variant.synthetize, cache=cache, previous=previous, images=images,
+                    output_format=variant.output_format, defer_write=defer_write,
+                    png_compression=variant.png_compression))
+            elif variant in primaries:
+                results.append(prepare_duplicate_lesion_row(
+                    row, out_folder, severity=variant.severity, primary=primaries[variant], previous=previous,
+                    output_format=variant.output_format, duplicate_scans=variant.duplicate_scans,
+                    defer_write=defer_write))
+            else:
+                keep_data = len(rows) > 1 and variant.duplicate_scans == 'copy'
+                # Linked files need the file of the first row to be written by the worker
+                write_now = variant.duplicate_scans == 'link' or not defer_write
+                output_path, entry = primaries[variant] = prepare_lesion_row(
+                    row, data_dir, out_folder, img_size=variant.img_size, severity=variant.severity,
+                    synthetize=variant.synthetize, cache=cache, previous=previous, images=images,
+                    output_format=variant.output_format, crop_breast=variant.crop_breast,
+                    defer_write=keep_data or not write_now, png_compression=variant.png_compression)
+                if write_now and 'data' in entry:
+                    write_file(output_path, entry['data'])
+                    entry = {key: value for key, value in entry.items() if key != 'data'}
+                results.append((output_path, entry))
+        all_results.append(results)
+    return all_results
+
+
+def mammogram_labels(rows: list, outputs: list):
+    """Labels of the rows sharing a mammogram in each scan variant, '|' separated"""
+    labels = {}
+    for row, row_outputs in zip(rows, outputs):
+        for variant, out_folder, _ in row_outputs:
+            if variant.family == 'scan':
+                output_path = variant.output_path(row, out_folder)
+                labels.setdefault(variant, set()).add(os.path.basename(os.path.dirname(output_path)))
+    return {variant: '|'.join(sorted(variant_labels)) for variant, variant_labels in labels.items()}
+
+
+def pack_output(writers: dict, variant: Variant, output_path: str, image, record, shard_size: int):
+    """Add a prepared image to the shard writer of its split, creating the writer if needed.
+    The split, label and sample key are derived from the path the image would have as a png."""
+    split, label = os.path.relpath(output_path, variant.task_dir).split(os.sep)[:2]
+    if (variant, split) not in writers:
+        writers[(variant, split)] = get_shard_writer(
+            variant.output_format, os.path.join(variant.task_dir, split), shard_size)
+    metadata = {'label': label, 'name': record.name, 'patient_id': record.patient_id,
+                'left_or_right_breast': record.left_or_right_breast, 'image_view': record.image_view,
+                'abnormality_id': record.abnormality_id, 'pathology': record.pathology}
+    writers[(variant, split)].add(f'{label}_{record.name}', image, metadata)
+
+
+def output_sample(variant: Variant, output_path: str, record, labels: str = None):
+    """Sample table row of an output, shard samples being named ``split/key``"""
+    output = os.path.relpath(output_path, variant.task_dir)
+    split, label = output.split(os.sep)[:2]
+    if variant.output_format not in IMAGE_FORMATS:
+        output = f'{split}/{label}_{record.name}'
+    return sample_row(output, split, label, record, labels)
+
+
+def patient_folds(records: list, folds: int, seed: int = 0):
+    """Cross validation fold of each patient, stratified on the lesion type and pathology of its rows"""
+    labels = []
+    for record in records:
+        sev = 'BENIGN' if record.pathology == 'BENIGN_WITHOUT_CALLBACK' else record.pathology
+        labels.append(f'{record.abnormality_type}_{sev}')
+    return assign_folds([record.patient_id for record in records], labels, folds, seed)
+
+
+def prepare_datasets(data_dir: str, variants: list, cache=None, pool: WorkerPool = None, shard_size: int = 1000, early_downsample: bool = False, folds: int = None, fold_seed: int = 0):
+    """Prepare several dataset variants in a single pass over the corrected csv files.
+    Each mammogram is loaded once and all the variants using its rows are written from the same
+    images. The rows of a mammogram, one per abnormality, are sent together to a worker and the
+    mammograms of all the csv files are scheduled together, largest first.
+
+    Variants saved as image files (png, npy, lossless WebP or TIFF) are updated incrementally
+    through their manifest while the shard formats are rebuilt from scratch, the images being
+    packed by this process.
+
+    When the pool limits its in-flight items, the run is streamed: the DICOM files of the
+    next rows are read ahead by background threads, the workers decode and transform the
+    rows, and the encoded image files are written by background threads of this process.
+
+    Every task folder gets a ``samples.csv`` table giving, for each output, its split, label,
+    case description metadata, source DICOM files and cross validation fold. Folds group
+    the train rows by patient, so that all the images of a patient are in the same fold.
+
+    Args:
+        data_dir (str): Path to original cbis dataset
+        variants (list): variants to prepare, see make_variants
+        cache (DicomCache): Optional decoded image cache shared across runs
+        pool (WorkerPool): Worker pool of the run, a temporary one is created if not given
+        shard_size (int): Number of images per shard for the shard formats
+        early_downsample (bool): Whether to downsample the mammograms right after decoding for the
+            rows only used by scan tasks
+        folds (int): Number of patient grouped, stratified, cross validation folds of the train split,
+            None to leave the fold column at -1
+        fold_seed (int): seed of the fold assignment
+    """
+    manifests = {variant: Manifest(variant.task_dir) for variant in variants
+                 if variant.output_format in IMAGE_FORMATS}
+    for variant in variants:
+        if variant.output_format not in IMAGE_FORMATS:
+            shutil.rmtree(variant.task_dir, ignore_errors=True)
+    shard_writers = {}
+    samples = {variant: [] for variant in variants}
+    records, outputs, train_records = [], [], []
+    for csv_data_file in glob(data_dir + '/*corrected.csv'):
+        csv_variants = [v for v in variants if v.uses_csv(csv_data_file)]
+        if not csv_variants:
+            continue
+        logging.info(f'Saving images defined in {csv_data_file}')
+        data_type = 'train' if 'train' in csv_data_file else 'test'
+        csv_records = read_case_records(csv_data_file)
+        cls = csv_records[0].abnormality_type
+        pathologies = ['BENIGN', 'MALIGNANT']
+
+        out_folders = [v.out_folder(data_type, cls) for v in csv_variants]
+        for variant, out_folder in zip(csv_variants, out_folders):
+            if variant.output_format not in IMAGE_FORMATS:
+                continue
+            if variant.severity:
+                for i in pathologies:
+                    os.makedirs(os.path.join(out_folder, f'{cls}_{i}'), exist_ok=True)
+            else:
+                os.makedirs(out_folder, exist_ok=True)
+
+        records.extend(csv_records)
+        if data_type == 'train':
+            train_records.extend(csv_records)
+        outputs.extend(
+            tuple((v, out_folder, manifests[v].get(v.output_path(record, out_folder)) if v in manifests else None)
+                  for v, out_folder in zip(csv_variants, out_folders))
+            for record in csv_records
+        )
+
+    owns_pool = pool is None
+    if owns_pool:
+        pool = WorkerPool()
+    prefetcher = writer = None
+    try:
+        with stage('dicom_index'):
+            dicom_index = load_dicom_index(data_dir, [path for record in records for path in
+                                                      (record.image_file_path, record.roi_mask_file_path)], pool)
+            resolve_dicom_files(records, data_dir, dicom_index)
+        groups = {}
+        for record, row_outputs in zip(records, outputs):
+            if record.image_file is None:
+                # Mammogram file not found, skipped by resolve_dicom_files
+                continue
+            groups.setdefault(record.image_file, []).append((record, row_outputs))
+        groups = sorted(groups.values(), key=lambda group: group[0][0].image_size or 0, reverse=True)
+        for group in groups:
+            # Merged scans are saved with the label of a malignant abnormality of the mammogram if any
+            group.sort(key=lambda item: item[0].pathology != 'MALIGNANT')
+        record_groups = [[record for record, _ in group] for group in groups]
+        output_groups = [[row_outputs for _, row_outputs in group] for group in groups]
+
+        streaming = pool.max_inflight is not None
+        prefetcher = FilePrefetcher() if streaming and cache is None else None
+        writer = OutputWriter(max_pending=pool.max_inflight) if streaming else None
+
+        def prefetch(rows, *args):
+            prefetcher.prefetch([rows[0].image_file] + [path for row in rows for path in row.mask_files])
+
+        all_results = pool.map(prepare_rows, record_groups, repeat(data_dir), output_groups, repeat(cache),
+                               repeat(early_downsample), repeat(streaming), total=len(groups),
+                               prefetch=prefetch if prefetcher is not None else None)
+        for group_records, group_outputs, group_results in zip(record_groups, output_groups,
+                                                                tqdm(all_results, total=len(groups))):
+            with stage('record_outputs'):
+                labels = mammogram_labels(group_records, group_outputs)
+                for record, row_outputs, results in zip(group_records, group_outputs, group_results):
+                    for (variant, out_folder, previous), result in zip(row_outputs, results):
+                        if result == MERGED:
+                            continue
+                        if result is None:
+                            # Failed row, the output of a previous run is kept until the row succeeds
+                            output_path = variant.output_path(record, out_folder)
+                            if variant not in manifests or previous is None or not os.path.exists(output_path):
+                                continue
+                            result = output_path, previous
+                        output_path, entry = result
+                        samples[variant].append(output_sample(variant, output_path, record, labels.get(variant)))
+                        if variant.output_format not in IMAGE_FORMATS:
+                            pack_output(shard_writers, variant, output_path, entry['image'], record, shard_size)
+                        elif 'data' in entry:
+                            data = entry.pop('data')
+                            writer.write(output_path, data, partial(manifests[variant].record, output_path, entry))
+                        else:
+                            manifests[variant].record(output_path, entry)
+    finally:
+        if writer is not None:
+            writer.close()
+        if prefetcher is not None:
+            prefetcher.shutdown()
+        if owns_pool:
+            pool.shutdown()
+    with stage('finalize_outputs'):
+        for writer in shard_writers.values():
+            writer.close()
+        for manifest in manifests.values():
+            manifest.finalize()
+        folds_by_patient = patient_folds(train_records, folds, fold_seed) if folds else None
+        for variant, rows in samples.items():
+            os.makedirs(variant.task_dir, exist_ok=True)
+            write_sample_table(variant.task_dir, rows, folds_by_patient)
@@ -0,0 +1,196 @@
+import os
+import csv
+import logging
+from glob import glob
+from dataclasses import dataclass, field
+from src.tasks.registry import DUPLICATE_SCAN_POLICIES, TASKS, make_variants
+from src.utils.formats import IMAGE_FORMATS, SHARD_FORMATS
+from src.utils.manifest import MANIFEST_NAME
+
+
+# Typical compression ratio of the prepared images, measured with benchmarks.codec_bench on synthetized
+# ROI patches. Scans, with their black background, compress better, the estimates are upper bounds.
+COMPRESSION_RATIOS = {'png': 1.3, 'npy': 1.0, 'webp': 2.4, 'tiff': 1.5, 'tar-shards': 1.0, 'npy-shards': 1.0}
+
+
+@dataclass
+class PreparationConfig:
+    """Options of a preparation run, the command line options of run.py.
+    See the README for the description of each option.
+
+    Args:
+        data_dir (str): Path to original cbis dataset
+        out_dir (str): Path to save the prepared cbis dataset
+        tasks (list): task names, see TASKS
+        img_sizes (list): image sizes
+        patch_paddings (list): paddings around the ROI patches
+    """
+    data_dir: str
+    out_dir: str = './data'
+    tasks: list = field(default_factory=lambda: ['roi-severity'])
+    img_sizes: list = field(default_factory=lambda: [256])
+    patch_paddings: list = field(default_factory=lambda: [100])
+    synthetize: bool = False
+    aug_ratio: int = 8
+    aug_seed: int = 0
+    cache_dir: str = None
+    cache_size: float = 50.0
+    workers: int = None
+    chunksize: int = None
+    max_inflight: int = None
+    output_format: str = 'png'
+    png_compression: int = None
+    shard_size: int = 1000
+    early_downsample: bool = False
+    crop_breast: bool = False
+    duplicate_scans: str = 'copy'
+    folds: int = None
+    fold_seed: int = 0
+    profile: bool = False
+    cprofile_dir: str = None
+
+    def __post_init__(self):
+        unknown = [task for task in self.tasks if task not in TASKS]
+        if unknown:
+            raise ValueError(f'Unknown tasks {", ".join(unknown)}, expected some of {", ".join(TASKS)}')
+        if self.output_format not in IMAGE_FORMATS + SHARD_FORMATS:
+            raise ValueError(f'Unknown output format {self.output_format}')
+        if self.duplicate_scans not in DUPLICATE_SCAN_POLICIES:
+            raise ValueError(f'Unknown duplicate scan policy {self.duplicate_scans}')
+        if self.png_compression is not None and not 0 <= self.png_compression <= 9:
+            raise ValueError('png_compression must be between 0 and 9')
+
+
+def read_case_rows(data_dir: str):
+    """Read the case description files with the csv module, the corrected ones if they exist
+
+    Returns:
+        dict: csv file path -> list of rows as dicts
+    """
+    csv_files = glob(os.path.join(data_dir, '*corrected.csv')) or \
+        glob(os.path.join(data_dir, '*_case_description_*_set.csv'))
+    rows = {}
+    for csv_file in csv_files:
+        with open(csv_file, newline='') as f:
+            rows[csv_file] = list(csv.DictReader(f))
+    return rows
+
+
+class Pipeline:
+    """Preparation of the CBIS-DDSM dataset described by a PreparationConfig, as run by run.py.
+
+    The stages can be run one at a time, e.g. from a notebook. Each stage imports the
+    dependencies it needs when it runs, so that creating the pipeline and planning the
+    run with ``plan`` stay fast.
+
+    Args:
+        config (PreparationConfig): options of the run
+    """
+
+    def __init__(self, config: PreparationConfig):
+        self.config = config
+        self.variants = make_variants(config.out_dir, config.tasks, config.img_sizes, config.patch_paddings,
+                                      config.synthetize, config.output_format, config.crop_breast,
+                                      config.png_compression, config.duplicate_scans)
+
+    def plan(self):
+        """Number of outputs of each variant and estimated size on disk, read from the csv
+        files only, without correcting them or reading any image
+
+        Returns:
+            dict: one entry per variant task folder, and the 'total' of the run
+        """
+        config = self.config
+        case_rows = read_case_rows(config.data_dir)
+        plan = {}
+        for variant in self.variants:
+            counts = {'train': 0, 'test': 0}
+            for csv_file, rows in case_rows.items():
+                if not variant.uses_csv(csv_file):
+                    continue
+                if variant.family == 'scan' and variant.duplicate_scans == 'merge':
+                    # A single output per mammogram
+                    rows = {row.get('image_file_path', row.get('image file path')): row for row in rows}
+                counts['train' if 'train' in os.path.basename(csv_file) else 'test'] += len(rows)
+            augmented = counts['train'] * config.aug_ratio
+            channels = 3 if variant.synthetize else 1
+            # Augmented image files are read, and saved, as 3 channels images
+            augmented_channels = 3 if variant.output_format in IMAGE_FORMATS else channels
+            raw_bytes = variant.img_size ** 2 * (channels * (counts['train'] + counts['test'])
+                                                 + augmented_channels * augmented)
+            manifest_path = os.path.join(variant.task_dir, MANIFEST_NAME)
+            existing = 0
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    existing = sum(1 for _ in f)
+            plan[variant.task_dir] = {'train': counts['train'], 'test': counts['test'], 'augmented': augmented,
+                                      'existing': existing,
+                                      'estimated_bytes': int(raw_bytes / COMPRESSION_RATIOS[variant.output_format])}
+        plan['total'] = {key: sum(variant_plan[key] for variant_plan in plan.values())
+                         for key in ('train', 'test', 'augmented', 'existing', 'estimated_bytes')}
+        return plan
+
+    def correct_metadata(self):
+        """Create the corrected csv files if they do not exist yet"""
+        from src.utils.metadata import correct_metadata_files
+        if len(glob(self.config.data_dir + '/*corrected.csv')) != 4:
+            logging.info('Corrected csv files not found. Creating ...')
+            correct_metadata_files(self.config.data_dir)
+            logging.info(f'Corrected csv files saved at {self.config.data_dir}')
+
+    def make_cache(self):
+        """Decoded DICOM cache of the run, None when no cache folder is configured"""
+        if self.config.cache_dir is None:
+            return None
+        from src.utils.cache import DicomCache
+        logging.info(f'Using decoded DICOM cache at {self.config.cache_dir}')
+        return DicomCache(self.config.cache_dir, int(self.config.cache_size * 1024 ** 3))
+
+    def make_pool(self, profiler=None):
+        from src.utils.pool import WorkerPool
+        return WorkerPool(self.config.workers, self.config.chunksize, profiler, self.config.max_inflight)
+
+    def prepare(self, pool=None, cache=None):
+        """Prepare every variant in a single pass over the corrected csv files, see prepare_datasets"""
+        from src.tasks.pipeline import prepare_datasets
+        config = self.config
+        prepare_datasets(config.data_dir, self.variants, cache, pool, config.shard_size, config.early_downsample,
+                         config.folds, config.fold_seed)
+
+    def augment(self, pool=None):
+        """Add the augmented images to the train split of every variant, see make_augmentation.
+        With an aug_ratio of 0, the augmented images of previous runs are removed."""
+        from src.utils.augmentations import make_augmentation
+        for variant in self.variants:
+            make_augmentation(os.path.join(variant.task_dir, 'train'), self.config.aug_ratio, pool,
+                              self.config.aug_seed, self.config.png_compression, self.config.shard_size)
+
+    def run(self):
+        """Run every stage with a shared worker pool
+
+        Returns:
+            dict: profiling summary, see Profiler.summary, None when profiling is disabled
+        """
+        config = self.config
+        logging.info(f'Creating dataset for {", ".join(config.tasks)} task')
+        self.correct_metadata()
+        cache = self.make_cache()
+        profiler = None
+        if config.profile or config.cprofile_dir:
+            from src.utils.profiling import Profiler
+            profiler = Profiler(config.cprofile_dir)
+        try:
+            with self.make_pool(profiler) as pool:
+                self.prepare(pool, cache)
+                self.augment(pool)
+
+            if profiler is None:
+                return None
+            profile_path = os.path.join(config.out_dir, 'profile.json')
+            summary = profiler.report(profile_path)
+            logging.info(f'Profile saved at {profile_path}')
+            return summary
+        finally:
+            # Later runs of the same process, e.g. in a notebook, are not profiled unless requested
+            if profiler is not None:
+                profiler.close()
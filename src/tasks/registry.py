@@ -0,0 +1,121 @@
+import os
+from dataclasses import dataclass
+from src.utils.formats import image_extension
+
+
+# task name -> (family, severity, lesion type), see register_task
+TASKS = {
+    'scan': ('scan', False, None),
+    'scan-severity': ('scan', True, None),
+    'scan-mass-severity': ('scan', True, 'mass'),
+    'scan-calc-severity': ('scan', True, 'calc'),
+    'roi-severity': ('roi', True, None),
+    'roi-mass-severity': ('roi', True, 'mass'),
+    'roi-calc-severity': ('roi', True, 'calc'),
+}
+
+# How the scan outputs of the rows sharing a mammogram are saved, see prepare_duplicate_lesion_row
+DUPLICATE_SCAN_POLICIES = ('copy', 'link', 'merge')
+
+
+def register_task(name: str, family: str, severity: bool, lesion_type: str = None):
+    """Add a task that can be prepared by make_variants and selected with --task
+
+    Args:
+        name (str): task name, also the name of its folder
+        family (str): 'scan' for whole breast images, 'roi' for lesion patches
+        severity (bool): Whether to create classes for pathologies or not
+        lesion_type (str): 'mass' or 'calc' to restrict the task to one lesion type, None for both
+    """
+    if family not in ('scan', 'roi'):
+        raise ValueError(f"Unknown task family {family}, expected 'scan' or 'roi'")
+    TASKS[name] = (family, severity, lesion_type)
+
+
+@dataclass(frozen=True)
+class Variant:
+    """One prepared dataset: a task at a given image size, padding and synthetization.
+
+    Args:
+        task_dir (str): Folder where the variant is saved
+        family (str): 'scan' for whole breast images, 'roi' for lesion patches
+        severity (bool): Whether to create classes for pathologies or not
+        lesion_type (str): 'mass' or 'calc' to restrict the variant to one lesion type, None for both
+        img_size (int): New image size
+        patch_padding (int): Padding around the ROI patches, only used by the roi family
+        synthetize (bool): Whether to save CLAHE synthetized images
+        output_format (str): one of IMAGE_FORMATS for one file per image, or one of SHARD_FORMATS
+        crop_breast (bool): Whether to crop the scans to the breast region, only used by the scan family
+        png_compression (int): zlib level of the png files, from 0 to 9, None for the OpenCV default
+        duplicate_scans (str): How the scans of the rows sharing a mammogram are saved, one of
+            DUPLICATE_SCAN_POLICIES, see prepare_duplicate_lesion_row
+    """
+    task_dir: str
+    family: str
+    severity: bool
+    lesion_type: str
+    img_size: int
+    patch_padding: int = None
+    synthetize: bool = False
+    output_format: str = 'png'
+    crop_breast: bool = False
+    png_compression: int = None
+    duplicate_scans: str = 'copy'
+
+    def uses_csv(self, csv_data_file: str):
+        return not self.lesion_type or self.lesion_type in os.path.basename(csv_data_file)
+
+    def out_folder(self, data_type: str, cls: str):
+        if self.severity:
+            return os.path.join(self.task_dir, data_type)
+        return os.path.join(self.task_dir, data_type, cls)
+
+    def output_path(self, row, out_folder: str):
+        # Imported here so that planning a run does not load the image processing dependencies
+        from src.tasks.lesion import lesion_output_path
+        from src.tasks.roi import roi_output_path
+        extension = image_extension(self.output_format)
+        if self.family == 'roi':
+            return roi_output_path(row, out_folder, extension)
+        return lesion_output_path(row, out_folder, self.severity, extension)
+
+
+def make_variants(out_dir: str, tasks: list, img_sizes: list, patch_paddings: list = [100], synthetize: bool = False, output_format: str = 'png', crop_breast: bool = False, png_compression: int = None, duplicate_scans: str = 'copy'):
+    """Build the variants for every combination of task, image size and patch padding.
+    Image sizes and paddings are appended to the task folder name only when several are requested.
+
+    Args:
+        out_dir (str): Path to save the prepared cbis dataset
+        tasks (list): task names, see TASKS
+        img_sizes (list): image sizes
+        patch_paddings (list): paddings around the ROI patches
+        synthetize (bool): Whether to save CLAHE synthetized images
+        output_format (str): one of IMAGE_FORMATS for one file per image, or one of SHARD_FORMATS
+        crop_breast (bool): Whether to crop the scans to the breast region
+        png_compression (int): zlib level of the png files, from 0 to 9, None for the OpenCV default
+        duplicate_scans (str): How the scans of the rows sharing a mammogram are saved, see DUPLICATE_SCAN_POLICIES
+
+    Returns:
+        list: variants
+    """
+    syn_str = '_synthetized' if synthetize else ''
+    tasks, img_sizes, patch_paddings = (list(dict.fromkeys(values))
+                                        for values in (tasks, img_sizes, patch_paddings))
+    variants = []
+    for task in tasks:
+        if task not in TASKS:
+            raise ValueError(f'Unknown task {task}, expected one of {", ".join(TASKS)}')
+        family, severity, lesion_type = TASKS[task]
+        paddings = patch_paddings if family == 'roi' else [None]
+        for img_size in img_sizes:
+            for patch_padding in paddings:
+                name = task
+                if len(img_sizes) > 1:
+                    name += f'_{img_size}'
+                if patch_padding is not None and len(patch_paddings) > 1:
+                    name += f'_pad{patch_padding}'
+                variants.append(Variant(os.path.join(out_dir, name + syn_str), family, severity,
+                                        lesion_type, img_size, patch_padding, synthetize, output_format,
+                                        crop_breast and family == 'scan', png_compression,
+                                        duplicate_scans))
+    return variants
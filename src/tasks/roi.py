@@ -1,72 +1,54 @@
-import shutil
 import os
-import logging
 import cv2
-import pandas as pd
-from tqdm import tqdm
-from glob import glob
-from src.utils.dicom import load_dicom_image, load_dicom_mask
-from src.utils.crop import extract_patch
-from concurrent.futures import ProcessPoolExecutor
-from src.utils.preprocessing import clahe
+from src.utils.formats import image_extension
+from src.utils.crop import patch_bounds
+from src.utils.loading import RowImages
+from src.utils.manifest import file_signature, is_up_to_date, write_output
+from src.utils.profiling import stage
 
 
-def prepare_roi_severity_row(row, data_dir: str, out_folder: str, img_size: int, patch_padding: int, synthetize: bool = False):
+def roi_output_path(row, out_folder: str, extension: str = '.png'):
+    sev = 'BENIGN' if row['pathology'] == 'BENIGN_WITHOUT_CALLBACK' else row['pathology']
+    return os.path.join(
+        out_folder, '{}_{}'.format(row['abnormality type'], sev), "{}{}".format(row.name, extension))
+
+
+def prepare_roi_severity_row(row, data_dir: str, out_folder: str, img_size: int, patch_padding: int, synthetize: bool = False, cache=None, previous: dict = None, images: RowImages = None, output_format: str = 'png', defer_write: bool = False, png_compression: int = None):
     try:
-        sev = 'BENIGN' if row['pathology'] == 'BENIGN_WITHOUT_CALLBACK' else row['pathology']
-        image_path = os.path.join(data_dir, row['image_file_path'])
-        image = load_dicom_image(glob(image_path + '/*.dcm')[0])
-        if synthetize:
-            image = cv2.merge((image, clahe(image, 1.0), clahe(image, 2.0)))
-        mask_file_path = row['roi_mask_file_path']
-        mask_path = glob(os.path.join(data_dir, mask_file_path, '*.dcm'))
-        mask = load_dicom_mask(mask_path, image.shape)
+        if images is None:
+            images = RowImages(row, data_dir, cache)
+
+        output_image_path = roi_output_path(row, out_folder, image_extension(output_format))
+        inputs = file_signature([images.image_file] + sorted(images.mask_files))
+        params = {'img_size': img_size, 'patch_padding': patch_padding, 'synthetize': synthetize}
+        if output_format == 'png' and png_compression is not None:
+            params['png_compression'] = png_compression
+        if is_up_to_date(previous, output_image_path, inputs, params):
+            return output_image_path, previous
+
+        mask = images.mask
 
         if mask is not None:
-            patch = extract_patch(image, mask, patch_padding)
-            resized_patch = cv2.resize(
-                patch,
-                (img_size, img_size),
-                interpolation=cv2.INTER_LINEAR
-            )
-            output_image_path = os.path.join(
-                out_folder, '{}_{}'.format(row['abnormality type'], sev), "{}.png".format(row.name))
-            cv2.imwrite(output_image_path, resized_patch)
+            with stage('extract_patch'):
+                bounds = patch_bounds(images.image.shape, mask, patch_padding)
+            patch = images.get_region(*bounds, synthetize)
+            with stage('resize'):
+                resized_patch = cv2.resize(
+                    patch,
+                    (img_size, img_size),
+                    interpolation=cv2.INTER_LINEAR
+                )
+            return write_output(output_image_path, resized_patch, inputs, params, output_format, defer_write,
+                                png_compression)
         else:
             raise
     except Exception as e:
         print(f"Failed to process row {row['roi_mask_file_path']}: {e}")
 
 
-def prepare_roi_severity_dataset(data_dir: str, out_dir: str, img_size: int, task: str, roi_type: str = None, patch_padding: int = 200, synthetize: bool = False):
-    shutil.rmtree(os.path.join(
-        out_dir, task, "_synthetized" if synthetize else ""), ignore_errors=True)
-    csv_file_list = glob(data_dir + '/*corrected.csv') if not roi_type else glob(
-        data_dir + f'/*{roi_type}*corrected.csv')
-    for csv_data_file in csv_file_list:
-        logging.info(f'Saving images defined in {csv_data_file}')
-        data_type = 'train' if 'train' in csv_data_file else 'test'
-        df = pd.read_csv(csv_data_file)
-        cls = df['abnormality type'].iloc[0]
-        pathologies = ['BENIGN', 'MALIGNANT']
-        syn_str = '_synthetized' if synthetize else ''
-        out_folder = os.path.join(out_dir, task + syn_str,
-                                  data_type)
-        for i in pathologies:
-            os.makedirs(os.path.join(out_folder, f'{cls}_{i}'), exist_ok=True)
-
-        with ProcessPoolExecutor() as executor:
-            list(
-                tqdm(
-                    executor.map(
-                        prepare_roi_severity_row,
-                        [row for _, row in df.iterrows()],
-                        [data_dir] * len(df),
-                        [out_folder] * len(df),
-                        [img_size] * len(df),
-                        [patch_padding] * len(df),
-                        [synthetize] * len(df)
-                    ),
-                    total=len(df),
-                )
-            )
+def prepare_roi_severity_dataset(data_dir: str, out_dir: str, img_size: int, task: str, roi_type: str = None, patch_padding: int = 200, synthetize: bool = False, cache=None):
+    from src.tasks.pipeline import prepare_datasets
+    from src.tasks.registry import Variant
+    syn_str = '_synthetized' if synthetize else ''
+    prepare_datasets(data_dir, [Variant(os.path.join(out_dir, task + syn_str), 'roi', True, roi_type,
+                                        img_size, patch_padding, synthetize)], cache)
@@ -1,16 +1,25 @@
 import os
 import cv2
+import random
 import logging
+import threading
+import numpy as np
 import albumentations as A
 from glob import glob
 from tqdm import tqdm
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.codecs import read_image, write_image
+from src.utils.formats import is_image_file
+from src.utils.manifest import AUGMENTATIONS_MANIFEST_NAME, Manifest, file_signature, is_up_to_date
+from src.utils.pool import WorkerPool
+from src.utils.profiling import add_bytes, is_enabled, stage
+from src.utils.samples import add_augmented_samples
+from src.utils.shards import INDEX_NAME, get_shard_writer, load_shard_sample, read_shard_index
 
 
-def make_augmentation(data_dir, num_augmentations: int = 3):
-
-    logging.info("Running data augmentation")
-
-    augmentation_pipeline = A.Compose([
+def get_augmentation_pipeline():
+    return A.Compose([
         A.HorizontalFlip(p=0.5),
         A.VerticalFlip(p=0.5),
         A.Rotate(limit=45, border_mode=cv2.BORDER_CONSTANT, p=0.3),
@@ -23,24 +32,301 @@ def make_augmentation(data_dir, num_augmentations: int = 3):
         A.RandomResizedCrop(height=224, width=224, scale=(0.9, 1.0), p=0.5),
     ])
 
-    label_folders = glob(os.path.join(data_dir, '*'))
 
-    def augment_image(image_path):
-        image = cv2.imread(image_path)
-        augmented_images = []
+_pipeline = None
+
+
+def _get_pipeline():
+    """Augmentation pipeline of the current process, built once per worker"""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = get_augmentation_pipeline()
+    return _pipeline
+
+
+def seed_pipeline(pipeline, seed: int):
+    """Seed the random generators owned by an albumentations pipeline"""
+    pipeline.set_random_seed(seed % 2 ** 32)
+
+
+def iter_augmentations(image, num_augmentations: int, seed: int = None):
+    """Yield augmented versions of an image one at a time. The global random and
+    np.random states of the caller are left untouched.
+
+    Args:
+        image (np.array): image to augment
+        num_augmentations (int): number of augmented images
+        seed (int): seed making the augmentations reproducible, None to keep the current state
+
+    Yields:
+        np.array: augmented image
+    """
+    pipeline = _get_pipeline()
+    if seed is None or hasattr(pipeline, 'set_random_seed'):
+        if seed is not None:
+            seed_pipeline(pipeline, seed)
         for _ in range(num_augmentations):
-            augmented = augmentation_pipeline(image=image)['image']
-            augmented_images.append(augmented)
-        return augmented_images
+            yield pipeline(image=image)['image']
+        return
+
+    # Older albumentations versions draw from the global generators, which are
+    # seeded for the augmentations then given back to the caller after each image
+    caller_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    for _ in range(num_augmentations):
+        augmented = pipeline(image=image)['image']
+        state = random.getstate(), np.random.get_state()
+        random.setstate(caller_state[0])
+        np.random.set_state(caller_state[1])
+        yield augmented
+        caller_state = random.getstate(), np.random.get_state()
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+    random.setstate(caller_state[0])
+    np.random.set_state(caller_state[1])
+
+
+class BoundedWriter:
+    """Thread pool encoding and writing images in the background.
+    At most ``max_pending`` images are queued, ``write`` blocks once the queue is full.
+
+    Args:
+        threads (int): number of writer threads
+        max_pending (int): maximum number of images waiting to be written
+    """
+
+    def __init__(self, threads: int = 2, max_pending: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = []
+
+    def _write(self, path: str, image, png_compression: int = None):
+        try:
+            write_image(path, image, png_compression)
+        finally:
+            self._slots.release()
+
+    def write(self, path: str, image, png_compression: int = None):
+        """Queue an image, saved in the format given by the extension of its path"""
+        self._slots.acquire()
+        self._pending.append(self._executor.submit(self._write, path, image, png_compression))
+
+    def flush(self):
+        """Wait for the queued images to be written, raising the first write error"""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+
+_writer = None
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        _writer = BoundedWriter()
+    return _writer
+
+
+def augment_image_file(image_path: str, output_paths: list, seed: int, png_compression: int = None):
+    """Augment an image file, streaming each augmented image to the background writer
 
+    Args:
+        image_path (str): image to augment
+        output_paths (list): one output path per augmentation
+        seed (int): seed of this image's augmentations
+        png_compression (int): zlib level of the png files, None for the OpenCV default
+    """
+    with stage('read'):
+        image = read_image(image_path, color=True)
+    if is_enabled():
+        add_bytes(read=os.path.getsize(image_path))
+    writer = _get_writer()
+    augmentations = iter_augmentations(image, len(output_paths), seed)
+    for output_path in output_paths:
+        with stage('augment'):
+            augmented = next(augmentations)
+        # Time spent waiting for a free slot of the background writer
+        with stage('write_queue'):
+            writer.write(output_path, augmented, png_compression)
+    with stage('write_wait'):
+        writer.flush()
+
+
+def augment_shard_sample(split_dir: str, shard: str, offset: int, size: int, num_augmentations: int, seed: int):
+    """Load an image from its shard and return its augmented versions"""
+    with stage('read'):
+        image = load_shard_sample(split_dir, shard, offset, size)
+    add_bytes(read=size)
+    with stage('augment'):
+        return list(iter_augmentations(image, num_augmentations, seed))
+
+
+def make_shard_augmentation(data_dir, num_augmentations: int, pool: WorkerPool, seed: int = 0, shard_size: int = 1000):
+    """Add augmented images to a split packed in shards, see make_augmentation.
+    Augmented images are written to their own ``aug-shard-*`` shards, replacing previous ones.
+
+    Returns:
+        dict: source key -> keys of its augmented images
+    """
+    index = read_shard_index(data_dir)
+    previous = index['shard'].str.startswith('aug-')
+    for shard in index.loc[previous, 'shard'].unique():
+        os.remove(os.path.join(data_dir, shard))
+    index = index[~previous]
+    index.to_csv(os.path.join(data_dir, INDEX_NAME), index=False)
+    if num_augmentations <= 0 or index.empty:
+        return {key: [] for key in index['key']}
+
+    output_format = 'npy-shards' if index['shard'].iloc[0].endswith('.npy') else 'tar-shards'
+    writer = get_shard_writer(output_format, data_dir, shard_size, prefix='aug-shard')
+    metadata_columns = [c for c in index.columns if c not in ('key', 'shard', 'offset', 'size')]
+    seeds = [seed * 1000003 + i for i in range(len(index))]
+    results = pool.map(augment_shard_sample, repeat(data_dir), index['shard'], index['offset'], index['size'],
+                       repeat(num_augmentations), seeds, total=len(index))
+    augmented_keys = {}
+    for row, augmented_images in zip(tqdm(index.to_dict('records'), desc=f"Augmenting {data_dir} images"), results):
+        metadata = {c: row[c] for c in metadata_columns}
+        augmented_keys[row['key']] = [f"aug_{row['key']}_{j}" for j in range(len(augmented_images))]
+        for key, augmented in zip(augmented_keys[row['key']], augmented_images):
+            writer.add(key, augmented, metadata)
+    writer.close()
+    return augmented_keys
+
+
+def make_augmentation(data_dir, num_augmentations: int = 3, pool: WorkerPool = None, seed: int = 0,
+                      png_compression: int = None, shard_size: int = 1000):
+    """Add augmented images to every label folder of a prepared split.
+    Images are augmented in parallel, each one with its own seed so that the
+    results do not depend on the number of workers. Augmented images are saved in
+    the format of their source image. Splits packed in shards get additional shards
+    of augmented images. The augmented images are added to the sample table of the task,
+    with the fold of their source image.
+
+    The augmented image files are recorded in the ``augmentations.jsonl`` manifest of the split:
+    the images whose source, seed and parameters did not change are kept, and the augmented
+    images of previous runs which are no longer produced are deleted, all of them when
+    num_augmentations is 0.
+
+    Args:
+        data_dir (str): prepared split folder, e.g. out_dir/task/train
+        num_augmentations (int): number of augmented images created per image
+        pool (WorkerPool): Worker pool of the run, a temporary one is created if not given
+        seed (int): base seed of the augmentations
+        png_compression (int): zlib level of the png files, None for the OpenCV default
+        shard_size (int): Number of images per shard of augmented images, for splits packed in shards
+    """
+    if not os.path.isdir(data_dir):
+        return
+    logging.info("Running data augmentation")
+    task_dir, split = os.path.split(os.path.normpath(data_dir))
+
+    if os.path.exists(os.path.join(data_dir, INDEX_NAME)):
+        owns_pool = pool is None and num_augmentations > 0
+        if owns_pool:
+            pool = WorkerPool()
+        try:
+            augmented_keys = make_shard_augmentation(data_dir, num_augmentations, pool, seed, shard_size)
+        finally:
+            if owns_pool:
+                pool.shutdown()
+        add_augmented_samples(task_dir, split, {f'{split}/{key}': [f'{split}/{k}' for k in keys]
+                                                for key, keys in augmented_keys.items()})
+        logging.info("Augmentations finished.")
+        return
+
+    label_folders = sorted(path for path in glob(os.path.join(data_dir, '*')) if os.path.isdir(path))
+    if not os.path.exists(os.path.join(data_dir, AUGMENTATIONS_MANIFEST_NAME)):
+        # Augmented images of a run without manifest are unknown, they are all regenerated
+        for label in label_folders:
+            for previous_augmentation in glob(label + '/aug_*'):
+                if is_image_file(previous_augmentation):
+                    os.remove(previous_augmentation)
+    manifest = Manifest(data_dir, AUGMENTATIONS_MANIFEST_NAME)
+
+    image_paths, output_paths = [], []
     for label in label_folders:
-        number_of_images = glob(label + '/*.png')
-        with tqdm(total=len(number_of_images), desc=f"Augmenting {label} images") as pbar:
-            for i, img in enumerate(number_of_images):
-                augmented_images = augment_image(img)
-                for j, augmented_image in enumerate(augmented_images):
-                    output_path = f"{label}/aug_{i}_{j}.png"
-                    cv2.imwrite(output_path, augmented_image)
-                pbar.update()
+        # Sorted so that the seed and name of each augmented image do not depend on the listing order
+        number_of_images = [path for path in sorted(glob(label + '/*'))
+                            if is_image_file(path) and not os.path.basename(path).startswith('aug_')]
+        for i, img in enumerate(number_of_images):
+            extension = os.path.splitext(img)[1]
+            image_paths.append(img)
+            output_paths.append([f"{label}/aug_{i}_{j}{extension}" for j in range(num_augmentations)])
+    seeds = [seed * 1000003 + i for i in range(len(image_paths))]
+
+    jobs = []
+    for image_path, paths, image_seed in zip(image_paths, output_paths, seeds):
+        inputs = file_signature([image_path])
+        params = {'seed': image_seed}
+        if image_path.endswith('.png') and png_compression is not None:
+            params['png_compression'] = png_compression
+        previous = [manifest.get(path) for path in paths]
+        if all(is_up_to_date(entry, path, inputs, params) for entry, path in zip(previous, paths)):
+            for path, entry in zip(paths, previous):
+                manifest.record(path, entry)
+        else:
+            jobs.append((image_path, paths, image_seed, {'inputs': inputs, 'params': params}))
+
+    if jobs:
+        owns_pool = pool is None
+        if owns_pool:
+            pool = WorkerPool()
+        try:
+            results = pool.map(augment_image_file, [job[0] for job in jobs], [job[1] for job in jobs],
+                               [job[2] for job in jobs], repeat(png_compression), total=len(jobs))
+            for (_, paths, _, entry), _ in zip(jobs, tqdm(results, total=len(jobs),
+                                                          desc=f"Augmenting {data_dir} images")):
+                for path in paths:
+                    manifest.record(path, entry)
+        finally:
+            if owns_pool:
+                pool.shutdown()
+    manifest.finalize()
+    add_augmented_samples(task_dir, split, {
+        os.path.relpath(image_path, task_dir): [os.path.relpath(path, task_dir) for path in paths]
+        for image_path, paths in zip(image_paths, output_paths)})
 
     logging.info("Augmentations finished.")
+
+
+class OnTheFlyAugmentation:
+    """Iterable over augmented images of a prepared split, computed in memory
+    instead of being written to disk.
+
+    Each source image yields ``num_augmentations`` augmented images labelled with
+    the name of their folder. Item ``idx`` is always the same image for a given seed,
+    so the object can also be indexed by a training data loader.
+
+    Args:
+        data_dir (str): prepared split folder, e.g. out_dir/task/train
+        num_augmentations (int): number of augmented images per source image
+        seed (int): base seed of the augmentations, None for non reproducible augmentations
+    """
+
+    def __init__(self, data_dir: str, num_augmentations: int = 1, seed: int = 0):
+        self.num_augmentations = num_augmentations
+        self.seed = seed
+        self.samples = [(path, os.path.basename(label))
+                        for label in sorted(glob(os.path.join(data_dir, '*')))
+                        for path in sorted(glob(label + '/*'))
+                        if is_image_file(path) and not os.path.basename(path).startswith('aug_')]
+
+    def __len__(self):
+        return len(self.samples) * self.num_augmentations
+
+    def _seed(self, idx: int):
+        return None if self.seed is None else self.seed * 1000003 + idx
+
+    def __getitem__(self, idx: int):
+        path, label = self.samples[idx // self.num_augmentations]
+        image = next(iter_augmentations(read_image(path, color=True), 1, self._seed(idx)))
+        return image, label
+
+    def __iter__(self):
+        for i, (path, label) in enumerate(self.samples):
+            image = read_image(path, color=True)
+            for j in range(self.num_augmentations):
+                idx = i * self.num_augmentations + j
+                yield next(iter_augmentations(image, 1, self._seed(idx))), label
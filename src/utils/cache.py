@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import numpy as np
+from src.utils.dicom import load_dicom_image
+
+
+class DicomCache:
+    """On-disk cache of decoded and normalized DICOM images.
+
+    Each entry is stored as an uncompressed ``.npy`` array next to a small json
+    sidecar recording the source file size and mtime. Entries are keyed on the
+    source file and the name of the loader which decoded it. Entries are invalidated when
+    the source file changes and the least recently used ones are evicted once the
+    cache grows over ``max_bytes``. Cached arrays are returned memory-mapped and
+    read-only so that workers can use them without copying.
+
+    The cache only holds picklable attributes so it can be handed to pool workers.
+
+    Args:
+        cache_dir (str): Folder where the cached arrays are stored
+        max_bytes (int): Maximum size of the cache, None for no limit
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._used_bytes = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_paths(self, path: str, loader):
+        key = hashlib.sha1(f'{os.path.abspath(path)}:{loader.__name__}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + '.npy'), os.path.join(self.cache_dir, key + '.json')
+
+    def _read_meta(self, meta_path: str):
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, path: str, loader=load_dicom_image):
+        """Return the decoded image of a DICOM file, decoding it only on a cache miss.
+
+        Args:
+            path (str): Path to the DICOM file
+            loader (callable): Function decoding a DICOM file to a uint8 array
+
+        Returns:
+            np.array: read-only memory-mapped uint8 image
+        """
+        stat = os.stat(path)
+        array_path, meta_path = self._entry_paths(path, loader)
+        meta = self._read_meta(meta_path)
+        if meta is not None and meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime_ns:
+            try:
+                image = np.load(array_path, mmap_mode='r')
+                os.utime(meta_path)
+                return image
+            except (OSError, ValueError):
+                pass
+
+        image = loader(path)
+        self._put(path, loader, stat, image, array_path, meta_path)
+        return image
+
+    def _put(self, path: str, loader, stat, image, array_path: str, meta_path: str):
+        # Write to temporary files first so concurrent workers never read partial entries
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        with open(array_path + tmp_suffix, 'wb') as f:
+            np.save(f, np.ascontiguousarray(image))
+        with open(meta_path + tmp_suffix, 'w') as f:
+            json.dump({'path': os.path.abspath(path), 'loader': loader.__name__, 'size': stat.st_size,
+                      'mtime': stat.st_mtime_ns}, f)
+        os.replace(array_path + tmp_suffix, array_path)
+        os.replace(meta_path + tmp_suffix, meta_path)
+
+        if self.max_bytes is None:
+            return
+        if self._used_bytes is None:
+            self._used_bytes = self.size()
+        else:
+            self._used_bytes += os.path.getsize(array_path)
+        if self._used_bytes > self.max_bytes:
+            self.evict()
+
+    def size(self):
+        """Total size in bytes of the cached arrays"""
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                   if entry.name.endswith('.npy'))
+
+    def evict(self, target_ratio: float = 0.9):
+        """Remove the least recently used entries until the cache fits in
+        ``target_ratio * max_bytes``.
+
+        Args:
+            target_ratio (float): Fraction of max_bytes to keep after eviction
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            meta_path = entry.path[:-len('.npy')] + '.json'
+            try:
+                last_used = os.stat(meta_path).st_mtime
+            except OSError:
+                last_used = 0
+            entries.append((last_used, entry.stat().st_size, entry.path, meta_path))
+
+        used = sum(size for _, size, _, _ in entries)
+        for _, size, array_path, meta_path in sorted(entries):
+            if used <= self.max_bytes * target_ratio:
+                break
+            for p in (meta_path, array_path):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+            used -= size
+        self._used_bytes = used
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_used_bytes'] = None
+        return state
+
@@ -0,0 +1,71 @@
+import io
+import cv2
+import numpy as np
+from src.utils.formats import EXTENSIONS
+from src.utils.profiling import add_bytes, stage
+
+
+# Quality above 100 selects the lossless WebP encoder
+WEBP_LOSSLESS = 101
+
+
+def encode_image(image, output_format: str = 'png', png_compression: int = None):
+    """Encode an image with a lossless codec
+
+    Args:
+        image (np.array): uint8 image, grayscale or BGR
+        output_format (str): one of IMAGE_FORMATS
+        png_compression (int): zlib level of the png files, from 0 (fastest) to 9 (smallest),
+            None for the OpenCV default
+
+    Returns:
+        bytes: encoded image
+    """
+    if output_format == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(image))
+        return buffer.getvalue()
+    params = []
+    if output_format == 'png' and png_compression is not None:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    elif output_format == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, WEBP_LOSSLESS]
+    ok, buffer = cv2.imencode(EXTENSIONS[output_format], image, params)
+    if not ok:
+        raise IOError(f'Could not encode the image as {output_format}')
+    return buffer.tobytes()
+
+
+def write_image(path: str, image, png_compression: int = None):
+    """Encode and save an image in the format given by the extension of its path
+
+    Returns:
+        int: number of bytes written
+    """
+    output_format = next(f for f, ext in EXTENSIONS.items() if path.endswith(ext))
+    with stage('encode'):
+        data = encode_image(image, output_format, png_compression)
+    with stage('write'):
+        with open(path, 'wb') as f:
+            f.write(data)
+    add_bytes(written=len(data))
+    return len(data)
+
+
+def read_image(path: str, color: bool = False):
+    """Load an image saved in one of IMAGE_FORMATS
+
+    Args:
+        path (str): image file
+        color (bool): Whether to return a 3 channels BGR image, as cv2.imread does by default,
+            otherwise the image is returned as saved. WebP files always hold 3 channels.
+
+    Returns:
+        np.array: uint8 image
+    """
+    if path.endswith(EXTENSIONS['npy']):
+        image = np.load(path)
+        if color and image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return image
+    return cv2.imread(path, cv2.IMREAD_COLOR if color else cv2.IMREAD_UNCHANGED)
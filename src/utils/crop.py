@@ -3,17 +3,17 @@ import random
 import numpy as np
 
 
-def crop_to_roi(img):
-    """Crop a mammogram to breast ROI
+def otsu_breast_mask(img):
+    """Otsu threshold of a blurred mammogram
 
     Args:
-        img (np.array): original image
+        img (np.array): uint8 image
 
     Returns:
-        tuple: (cropped image, cropping mask, bounding box)
+        tuple: (threshold, breast mask, largest contour bounding box [x, y, w, h])
     """
     blur = cv2.GaussianBlur(img, (5, 5), 0)
-    _, breast_mask = cv2.threshold(
+    threshold, breast_mask = cv2.threshold(
         blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
     cnts, _ = cv2.findContours(
@@ -21,28 +21,124 @@ def crop_to_roi(img):
             np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
     )
     cnt = max(cnts, key=cv2.contourArea)
-    x, y, w, h = cv2.boundingRect(cnt)
+    return threshold, breast_mask, list(cv2.boundingRect(cnt))
+
+
+def crop_to_roi(img):
+    """Crop a mammogram to breast ROI
+
+    Args:
+        img (np.array): original image
+
+    Returns:
+        tuple: (cropped image, cropping mask, bounding box)
+    """
+    _, breast_mask, (x, y, w, h) = otsu_breast_mask(img)
     return img[y: y + h, x: x + w], breast_mask[y: y + h, x: x + w], [x, y, w, h]
 
 
+def breast_box(img, max_side: int = 512):
+    """Bounding box of the breast, found by crop_to_roi's Otsu method on a downsampled
+    copy of the image and mapped back to the image with a margin of one downsampled pixel
+
+    Args:
+        img (np.array): uint8 mammogram
+        max_side (int): approximate largest side of the downsampled copy
+
+    Returns:
+        tuple: (y_min, y_max, x_min, x_max, Otsu threshold)
+    """
+    height, width = img.shape[:2]
+    factor = max(1, max(height, width) // max_side)
+    small = img
+    if factor > 1:
+        small = cv2.resize(img, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+    threshold, _, (x, y, w, h) = otsu_breast_mask(small)
+    scale_y, scale_x = height / small.shape[0], width / small.shape[1]
+    return (max(0, int((y - 1) * scale_y)), min(height, int(np.ceil((y + h + 1) * scale_y))),
+            max(0, int((x - 1) * scale_x)), min(width, int(np.ceil((x + w + 1) * scale_x))), float(threshold))
+
+
 def crop_img(img, coordinates):
     x, y, w, h = coordinates
     return img[y: y + h, x: x + w]
 
 
-def extract_patch(image, mask, padding=200):
-    coords = np.argwhere(mask)
-    y_min, x_min = coords.min(axis=0)
-    y_max, x_max = coords.max(axis=0)
+def mask_bounds(mask):
+    """Bounding box of the nonzero pixels of a mask, from row and column reductions instead of
+    the coordinates of every pixel. The columns are only reduced over the rows of the box,
+    see benchmarks/mask_bench.py.
 
+    Args:
+        mask (np.array): 2D mask
+
+    Returns:
+        tuple: (y_min, y_max, x_min, x_max), maximums included
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        raise ValueError('Empty mask')
+    cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    return rows[0], rows[-1], cols[0], cols[-1]
+
+
+def component_bounds(mask, min_area: int = 1):
+    """Bounding boxes of the connected components of a mask, largest component first
+
+    Args:
+        mask (np.array): 2D mask
+        min_area (int): components with fewer pixels are ignored
+
+    Returns:
+        list: (y_min, y_max, x_min, x_max) of each component, maximums included
+    """
+    if mask.dtype != np.uint8:
+        mask = (mask != 0).astype(np.uint8)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(np.asarray(mask), connectivity=8)
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_area]
+    stats = stats[np.argsort(-stats[:, cv2.CC_STAT_AREA], kind='stable')]
+    return [(y, y + h - 1, x, x + w - 1) for x, y, w, h, _ in stats.tolist()]
+
+
+def _pad_bounds(image_shape, bounds, padding):
+    y_min, y_max, x_min, x_max = bounds
     y_min = max(0, y_min - padding)
     x_min = max(0, x_min - padding)
-    y_max = min(image.shape[0], y_max + padding)
-    x_max = min(image.shape[1], x_max + padding)
+    y_max = min(image_shape[0], y_max + padding)
+    x_max = min(image_shape[1], x_max + padding)
+    return y_min, y_max, x_min, x_max
 
+
+def patch_bounds(image_shape, mask, padding=200):
+    """Bounds (y_min, y_max, x_min, x_max) of the padded bounding box of a mask, clipped to the image"""
+    return _pad_bounds(image_shape, mask_bounds(mask), padding)
+
+
+def extract_patch(image, mask, padding=200):
+    y_min, y_max, x_min, x_max = patch_bounds(image.shape, mask, padding)
     return image[y_min:y_max, x_min:x_max]
 
 
+def extract_patches(image, mask, padding=200, min_area: int = 1):
+    """One padded patch per connected component of the mask, for masks holding several disjoint lesions
+
+    Args:
+        image (np.array): mammogram
+        mask (np.array): ROI mask of the same size
+        padding (int): padding around each component
+        min_area (int): components with fewer pixels are ignored
+
+    Returns:
+        list: patches, largest component first
+    """
+    patches = []
+    for bounds in component_bounds(mask, min_area):
+        y_min, y_max, x_min, x_max = _pad_bounds(image.shape, bounds, padding)
+        patches.append(image[y_min:y_max, x_min:x_max])
+    return patches
+
+
 def random_crop(image, size=(200, 200)):
     height, width = image.shape[:2]
     top = random.randint(0, height - size[0])
@@ -1,10 +1,12 @@
+import os
 import cv2
 import numpy as np
 from pydicom import dcmread
 from pydicom.pixel_data_handlers import apply_voi_lut
+from src.utils.profiling import add_bytes, is_enabled
 
 
-def load_dicom_mask(roi_paths: list, x_shape: tuple):
+def load_dicom_mask(roi_paths: list, x_shape: tuple, cache=None, roi_shapes: list = None):
     """Loads the ROI mask associated to a mammogram.
     As some of the studies have 2 ROI files (one mask and one image patch) and that no information
     is given regarding their nature. This function checks which mask image has the same shape as the original data.
@@ -13,13 +15,21 @@ def load_dicom_mask(roi_paths: list, x_shape: tuple):
     Args:
         roi_paths (list): List of ROI files
         x_shape (tuple): Shape of the original mammogram image
+        cache (DicomCache): Optional decoded image cache
+        roi_shapes (list): (Rows, Columns) of each ROI file read from the DICOM headers,
+            when given only the selected file is decoded
 
     Returns:
         np.array: image mask or image patch
     """
+    if len(roi_paths) > 1 and roi_shapes is not None and None not in roi_shapes:
+        for roi_path, roi_shape in zip(roi_paths, roi_shapes):
+            if tuple(roi_shape) == (x_shape[0], x_shape[1]):
+                return load_mask(roi_path, cache)
+        return None
     if len(roi_paths) > 1:
-        base_mask = load_dicom_image(roi_paths[0])
-        second_mask = load_dicom_image(roi_paths[1])
+        base_mask = load_mask(roi_paths[0], cache)
+        second_mask = load_mask(roi_paths[1], cache)
 
         if base_mask.shape == (x_shape[0], x_shape[1]):
             return base_mask
@@ -28,17 +38,130 @@ def load_dicom_mask(roi_paths: list, x_shape: tuple):
         else:
             return None
     else:
-        mask = load_dicom_image(roi_paths[0])
+        mask = load_mask(roi_paths[0], cache)
         return mask
 
 
-def load_dicom_image(path):
+def load_mask(path: str, cache=None):
+    """Load a ROI mask, going through the decoded image cache when one is given, see load_dicom_mask_image"""
+    if cache is None:
+        return load_dicom_mask_image(path)
+    return cache.get(path, load_dicom_mask_image)
+
+
+def load_dicom(path: str, cache=None, target_size: int = None):
+    """Load a DICOM image, going through the decoded image cache when one is given
+
+    Args:
+        path (str): Path to the DICOM file
+        cache (DicomCache): Optional decoded image cache
+        target_size (int): Size the image will be resized to, enables the early downsampling
+
+    Returns:
+        np.array: uint8 image
+    """
+    if cache is None:
+        return load_dicom_image(path, target_size)
+    return downsample(cache.get(path), target_size)
+
+
+def downsample(img2d, target_size: int = None):
+    """Area downsample an image by the largest integer factor keeping it at least
+    twice as large as the target size, the final resize being left to the caller.
+
+    Args:
+        img2d (np.array): image
+        target_size (int): size the image will be resized to, None to keep the image as is
+
+    Returns:
+        np.array: downsampled image
+    """
+    if target_size is None:
+        return img2d
+    factor = min(img2d.shape[:2]) // (2 * target_size)
+    if factor < 2:
+        return img2d
+    height, width = img2d.shape[:2]
+    return cv2.resize(img2d, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+
+
+def normalize_to_uint8(img2d, ds):
+    """VOI LUT, MONOCHROME1 inversion and min-max normalization to uint8, computed
+    through a lookup table over the pixel values present in the image.
+
+    This gives the same result as applying each step to the whole image but only
+    allocates the uint8 output instead of several full size float copies.
+
+    Args:
+        img2d (np.array): unsigned integer pixel array
+        ds (Dataset): DICOM dataset of the image
+
+    Returns:
+        np.array: uint8 image
+    """
+    # Numpy indexes with intp, work on row blocks to avoid full size int64 copies
+    block = max(1, (1 << 20) // img2d.shape[1])
+    counts = np.zeros(1 << (8 * img2d.dtype.itemsize), dtype=np.int64)
+    for start in range(0, img2d.shape[0], block):
+        counts += np.bincount(img2d[start:start + block].ravel(), minlength=len(counts))
+    values = np.flatnonzero(counts).astype(img2d.dtype)
+    mapped = apply_voi_lut(values, ds)
+    if ds.PhotometricInterpretation == "MONOCHROME1":
+        mapped = np.amax(mapped) - mapped
+    mapped = cv2.normalize(
+        mapped, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F
+    ).astype(np.uint8).ravel()
+    lut = np.zeros(len(counts), dtype=np.uint8)
+    lut[values] = mapped
+    out = np.empty(img2d.shape, dtype=np.uint8)
+    for start in range(0, img2d.shape[0], block):
+        np.take(lut, img2d[start:start + block], out=out[start:start + block])
+    return out
+
+
+def load_dicom_mask_image(path):
+    """Decode a ROI mask to a uint8 image of 0 and 255, without the VOI LUT and
+    normalization of load_dicom_image. Pixels differing from the background, the
+    lowest value or the highest one for MONOCHROME1, are set to 255.
+
+    Args:
+        path (str): Path to the DICOM file
+
+    Returns:
+        np.array: uint8 mask
+    """
     ds = dcmread(path)
+    if is_enabled():
+        add_bytes(read=os.path.getsize(path))
+    pixels = ds.pixel_array
+    background = pixels.max() if ds.PhotometricInterpretation == "MONOCHROME1" else pixels.min()
+    mask = (pixels != background).view(np.uint8)
+    mask *= 255
+    return mask
+
+
+def load_dicom_image(path, target_size: int = None):
+    """Decode and normalize a DICOM image to uint8
+
+    Args:
+        path (str): Path to the DICOM file
+        target_size (int): Size the image will be resized to, when much smaller than the
+            image it is area downsampled right after decoding, see downsample
+
+    Returns:
+        np.array: uint8 image
+    """
+    ds = dcmread(path)
+    if is_enabled():
+        add_bytes(read=os.path.getsize(path))
     img2d = ds.pixel_array
-    img2d = apply_voi_lut(img2d, ds)
-    if ds.PhotometricInterpretation == "MONOCHROME1":
-        img2d = np.amax(img2d) - img2d
-    img2d = cv2.normalize(
-        img2d, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F
-    ).astype(np.uint8)
-    return img2d
+    if img2d.dtype.kind == 'u' and img2d.dtype.itemsize <= 2:
+        img2d = normalize_to_uint8(img2d, ds)
+    else:
+        img2d = apply_voi_lut(img2d, ds)
+        if ds.PhotometricInterpretation == "MONOCHROME1":
+            img2d = np.amax(img2d) - img2d
+        img2d = cv2.normalize(
+            img2d, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F
+        ).astype(np.uint8)
+    return downsample(img2d, target_size)
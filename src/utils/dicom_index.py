@@ -0,0 +1,86 @@
+import os
+import logging
+import pandas as pd
+from tqdm import tqdm
+from itertools import repeat
+from pydicom import dcmread
+from src.utils.pool import WorkerPool
+
+
+DICOM_INDEX_NAME = 'dicom_index.csv'
+INDEX_COLUMNS = ['series_path', 'file_name', 'size', 'mtime', 'sop_instance_uid', 'rows', 'columns']
+
+
+def scan_series_dir(data_dir: str, series_path: str, read_headers: bool = True):
+    """List the DICOM files of a series folder, optionally reading their headers
+
+    Args:
+        data_dir (str): Path to original cbis dataset
+        series_path (str): series folder, relative to data_dir
+        read_headers (bool): Whether to read SOPInstanceUID, Rows and Columns from the files
+
+    Returns:
+        list: one dict per DICOM file, empty if the folder does not exist
+    """
+    entries = []
+    try:
+        dir_entries = list(os.scandir(os.path.join(data_dir, series_path)))
+    except OSError as e:
+        logging.warning(f'Could not list the series folder {series_path}: {e}')
+        return entries
+    for entry in dir_entries:
+        if not entry.name.endswith('.dcm') or entry.name.startswith('.'):
+            continue
+        stat = entry.stat()
+        file_entry = {'series_path': series_path, 'file_name': entry.name,
+                      'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                      'sop_instance_uid': None, 'rows': -1, 'columns': -1}
+        if read_headers:
+            ds = dcmread(entry.path, stop_before_pixels=True,
+                         specific_tags=['SOPInstanceUID', 'Rows', 'Columns'])
+            file_entry.update(sop_instance_uid=ds.get('SOPInstanceUID'),
+                              rows=ds.get('Rows', -1), columns=ds.get('Columns', -1))
+        entries.append(file_entry)
+    return entries
+
+
+def load_dicom_index(data_dir: str, series_paths: list, pool: WorkerPool = None, read_headers: bool = True):
+    """Load the index of the DICOM files saved next to the corrected csv files,
+    scanning the series folders which are not indexed yet.
+
+    The folders are only listed once, following runs read the index instead.
+    Delete the index file to rescan the dataset after modifying its folders.
+
+    Args:
+        data_dir (str): Path to original cbis dataset
+        series_paths (list): series folders needed, relative to data_dir
+        pool (WorkerPool): Worker pool used to scan the folders, a temporary one is created if not given
+        read_headers (bool): Whether to read SOPInstanceUID, Rows and Columns from the files
+
+    Returns:
+        pd.DataFrame: one row per DICOM file, in folder listing order
+    """
+    index_path = os.path.join(data_dir, DICOM_INDEX_NAME)
+    index = pd.read_csv(index_path) if os.path.exists(index_path) else None
+    indexed = set() if index is None else set(index['series_path'])
+    missing = [p for p in dict.fromkeys(series_paths) if p not in indexed]
+    if not missing:
+        return index
+
+    logging.info(f'Indexing the DICOM files of {len(missing)} series')
+    owns_pool = pool is None
+    if owns_pool:
+        pool = WorkerPool()
+    try:
+        new_entries = [entry
+                       for entries in tqdm(pool.map(scan_series_dir, repeat(data_dir), missing,
+                                                    repeat(read_headers), total=len(missing)),
+                                           total=len(missing), desc='Indexing DICOM files')
+                       for entry in entries]
+    finally:
+        if owns_pool:
+            pool.shutdown()
+    index = pd.concat([index, pd.DataFrame(new_entries, columns=INDEX_COLUMNS)], ignore_index=True) \
+        if index is not None else pd.DataFrame(new_entries, columns=INDEX_COLUMNS)
+    index.to_csv(index_path, index=False)
+    return index
@@ -0,0 +1,17 @@
+import os
+
+
+# Formats saving one file per image, all of them lossless
+IMAGE_FORMATS = ('png', 'npy', 'webp', 'tiff')
+# Formats packing the images of a split in a few large files
+SHARD_FORMATS = ('tar-shards', 'npy-shards')
+EXTENSIONS = {'png': '.png', 'npy': '.npy', 'webp': '.webp', 'tiff': '.tiff'}
+
+
+def image_extension(output_format: str):
+    """Extension of the output files of a format, shard formats keep the png name of their samples"""
+    return EXTENSIONS.get(output_format, '.png')
+
+
+def is_image_file(path: str):
+    return os.path.splitext(path)[1] in EXTENSIONS.values()
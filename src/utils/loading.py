@@ -0,0 +1,169 @@
+import os
+import cv2
+import numpy as np
+from glob import glob
+from functools import cached_property
+from src.utils.crop import breast_box
+from src.utils.dicom import load_dicom, load_dicom_mask
+from src.utils.preprocessing import clahe_luts, linear_resize_support, synthetize_image, truncate_normalization
+from src.utils.profiling import stage
+
+
+class MammogramImages:
+    """Mammogram of one or several case description rows, and the images derived from it,
+    loaded on first access.
+
+    A single instance is shared by every output built from the same mammogram, the rows
+    of the lesions of a same image included, so that the mammogram and its CLAHE synthetized
+    version are decoded at most once, and not at all when every output is already up to date.
+
+    The CLAHE lookup tables of the mammogram are computed once, and ``get_region``
+    and ``resized`` only synthetize the pixels they need, giving the same result
+    as cropping or resizing the whole synthetized image.
+
+    Args:
+        row (CaseRecord): one of the case description rows of the mammogram, a pandas row can also be used
+        data_dir (str): Path to original cbis dataset
+        cache (DicomCache): Optional decoded image cache
+        target_size (int): Output size of the images, enables the early downsampling of the
+            mammogram, see load_dicom_image. Must be None when the ROI mask is used.
+    """
+
+    def __init__(self, row, data_dir: str, cache=None, target_size: int = None):
+        self.row = row
+        self.data_dir = data_dir
+        self.cache = cache
+        self.target_size = target_size
+
+    @cached_property
+    def image_file(self):
+        image_file = getattr(self.row, 'image_file', None)
+        if image_file is not None:
+            return image_file
+        with stage('glob'):
+            return glob(os.path.join(self.data_dir, self.row['image_file_path']) + '/*.dcm')[0]
+
+    @cached_property
+    def image(self):
+        with stage('dicom_decode'):
+            return load_dicom(self.image_file, self.cache, self.target_size)
+
+    @cached_property
+    def synthetized(self):
+        image = self.image
+        with stage('clahe'):
+            return synthetize_image(image)
+
+    @cached_property
+    def clahe_luts(self):
+        image = self.image
+        with stage('clahe'):
+            return clahe_luts(image)
+
+    @cached_property
+    def breast_box(self):
+        """(y_min, y_max, x_min, x_max, threshold) of the breast, see crop.breast_box.
+        Can be set beforehand with a box saved by a previous run."""
+        image = self.image
+        with stage('crop_breast'):
+            return breast_box(image)
+
+    @cached_property
+    def breast(self):
+        """Breast region of the mammogram, truncation normalized within the pixels above the Otsu threshold"""
+        y_min, y_max, x_min, x_max, threshold = self.breast_box
+        crop = self.image[y_min:y_max, x_min:x_max]
+        with stage('crop_breast'):
+            return truncate_normalization(crop, crop > threshold)
+
+    @cached_property
+    def synthetized_breast(self):
+        breast = self.breast
+        with stage('clahe'):
+            return synthetize_image(breast)
+
+    @cached_property
+    def breast_clahe_luts(self):
+        breast = self.breast
+        with stage('clahe'):
+            return clahe_luts(breast)
+
+    def get_image(self, synthetize: bool = False):
+        """Original image, or its 3 channels CLAHE synthetized version"""
+        return self.synthetized if synthetize else self.image
+
+    def _synthetized_pixels(self, rows, cols, crop_breast: bool = False):
+        synthetized = 'synthetized_breast' if crop_breast else 'synthetized'
+        if synthetized in self.__dict__:
+            return getattr(self, synthetized)[np.ix_(rows, cols)]
+        image = self.breast if crop_breast else self.image
+        luts = self.breast_clahe_luts if crop_breast else self.clahe_luts
+        with stage('clahe'):
+            return synthetize_image(image, rows, cols, luts)
+
+    def get_region(self, y_min: int, y_max: int, x_min: int, x_max: int, synthetize: bool = False):
+        """Crop of the original or synthetized image, only the crop is synthetized"""
+        if not synthetize:
+            return self.image[y_min:y_max, x_min:x_max]
+        return self._synthetized_pixels(np.arange(y_min, y_max), np.arange(x_min, x_max))
+
+    def resized(self, img_size: int, synthetize: bool = False, crop_breast: bool = False):
+        """Original or synthetized image resized to img_size x img_size with linear interpolation.
+        When much larger than img_size, the synthetized image is only computed at the pixels read by
+        the resize, the other pixels being left to zero. With crop_breast, the normalized breast
+        region is used instead of the whole image."""
+        image = self.breast if crop_breast else self.image
+        if synthetize:
+            synthetized = 'synthetized_breast' if crop_breast else 'synthetized'
+            height, width = image.shape
+            rows, cols = linear_resize_support(height, img_size), linear_resize_support(width, img_size)
+            if synthetized in self.__dict__ or 4 * len(rows) * len(cols) > height * width:
+                image = getattr(self, synthetized)
+            else:
+                sparse = np.zeros((height, width, 3), dtype=np.uint8)
+                sparse[np.ix_(rows, cols)] = self._synthetized_pixels(rows, cols, crop_breast)
+                image = sparse
+        with stage('resize'):
+            return cv2.resize(image, (img_size, img_size), interpolation=cv2.INTER_LINEAR)
+
+
+class RowImages:
+    """Images of a case description row: its ROI mask, loaded on first access, and the
+    images of its mammogram, which may be shared with the other rows of the same image.
+
+    A single instance is shared by every output built from the same row. Attributes and
+    methods of MammogramImages, e.g. ``image`` or ``resized``, can be used directly.
+
+    Args:
+        row (CaseRecord): case description row, a pandas row can also be used
+        data_dir (str): Path to original cbis dataset
+        cache (DicomCache): Optional decoded image cache
+        target_size (int): Output size of the images, see MammogramImages, ignored when a mammogram is given
+        mammogram (MammogramImages): images of the mammogram of the row, created if not given
+    """
+
+    def __init__(self, row, data_dir: str, cache=None, target_size: int = None, mammogram: MammogramImages = None):
+        self.row = row
+        self.data_dir = data_dir
+        self.cache = cache
+        self.mammogram = mammogram if mammogram is not None else MammogramImages(row, data_dir, cache, target_size)
+
+    def __getattr__(self, name: str):
+        # Only called for the attributes missing from the row, i.e. those of the mammogram
+        if name == 'mammogram':
+            raise AttributeError(name)
+        return getattr(self.mammogram, name)
+
+    @cached_property
+    def mask_files(self):
+        mask_files = getattr(self.row, 'mask_files', None)
+        if mask_files is not None:
+            return mask_files
+        with stage('glob'):
+            return glob(os.path.join(self.data_dir, self.row['roi_mask_file_path'], '*.dcm'))
+
+    @cached_property
+    def mask(self):
+        shape = self.image.shape
+        with stage('mask_decode'):
+            return load_dicom_mask(self.mask_files, shape, self.cache, getattr(self.row, 'mask_shapes', None))
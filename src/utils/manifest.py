@@ -0,0 +1,144 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from src.utils.formats import IMAGE_FORMATS
+from src.utils.profiling import add_bytes, stage
+
+
+MANIFEST_NAME = 'manifest.jsonl'
+# Manifest of the augmented images of a split, saved in the split folder, see make_augmentation
+AUGMENTATIONS_MANIFEST_NAME = 'augmentations.jsonl'
+
+
+def file_signature(paths: list):
+    """Describe input files by their path, size and modification time
+
+    Args:
+        paths (list): List of input file paths
+
+    Returns:
+        list: one {path, size, mtime} dict per file
+    """
+    signature = []
+    with stage('stat'):
+        for path in paths:
+            stat = os.stat(path)
+            signature.append({'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+    return signature
+
+
+def is_up_to_date(entry: dict, output_path: str, inputs: list, params: dict):
+    """Check whether a previous manifest entry can be reused as is
+
+    Args:
+        entry (dict): previous manifest entry, None if the output was never produced
+        output_path (str): Path of the output file
+        inputs (list): current input signature, see file_signature
+        params (dict): current preparation parameters
+
+    Returns:
+        bool: True if the output exists and was produced from the same inputs and parameters
+    """
+    return (entry is not None and entry['inputs'] == inputs
+            and entry['params'] == params and os.path.exists(output_path))
+
+
+def write_output(output_path: str, image, inputs: list, params: dict, output_format: str = 'png', defer_write: bool = False, png_compression: int = None):
+    """Encode and save an output image and build its manifest entry
+
+    Args:
+        output_path (str): Path of the output image
+        image (np.array): image to save
+        inputs (list): input signature, see file_signature
+        params (dict): preparation parameters
+        output_format (str): one of IMAGE_FORMATS to save the image, for the shard formats the
+            image is returned in the entry to be packed by the parent process
+        defer_write (bool): Whether to return the encoded image in the entry, as 'data', instead
+            of writing it, for the parent process to write it
+        png_compression (int): zlib level of the png files, None for the OpenCV default
+
+    Returns:
+        tuple: (output path, manifest entry)
+    """
+    if output_format not in IMAGE_FORMATS:
+        return output_path, {'inputs': inputs, 'params': params, 'image': image}
+    # Imported here so that reading a manifest does not load OpenCV
+    from src.utils.codecs import encode_image
+    with stage('encode'):
+        data = encode_image(image, output_format, png_compression)
+    entry = {'inputs': inputs, 'params': params, 'hash': hashlib.sha1(data).hexdigest()}
+    if defer_write:
+        return output_path, dict(entry, data=data)
+    with stage('write'):
+        with open(output_path, 'wb') as f:
+            f.write(data)
+    add_bytes(written=len(data))
+    return output_path, entry
+
+
+class Manifest:
+    """Record of the outputs of a prepared task folder, stored as ``manifest.jsonl``.
+
+    Each line describes one output file: its path relative to the task folder, the
+    input files it was built from, the preparation parameters and the hash of its
+    content. Entries are appended as soon as the outputs are written, so that an
+    interrupted run can be resumed, and the file is compacted by ``finalize``.
+
+    Args:
+        task_dir (str): Folder of the prepared task, or of the augmented split
+        name (str): manifest file name, AUGMENTATIONS_MANIFEST_NAME for the augmented images
+    """
+
+    def __init__(self, task_dir: str, name: str = MANIFEST_NAME):
+        self.task_dir = task_dir
+        self.path = os.path.join(task_dir, name)
+        self.previous = {}
+        self.current = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted run
+                        continue
+                    self.previous[entry['output']] = entry
+        elif name == MANIFEST_NAME:
+            # Outputs of a run without manifest are unknown, start from a clean folder
+            shutil.rmtree(task_dir, ignore_errors=True)
+        os.makedirs(task_dir, exist_ok=True)
+        self._file = open(self.path, 'a')
+
+    def _key(self, output_path: str):
+        return os.path.relpath(output_path, self.task_dir)
+
+    def get(self, output_path: str):
+        """Previous entry of an output file, None if unknown"""
+        return self.previous.get(self._key(output_path))
+
+    def record(self, output_path: str, entry: dict):
+        """Add the entry of an output produced, or kept, by the current run"""
+        entry = dict(entry, output=self._key(output_path))
+        self.current[entry['output']] = entry
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def finalize(self):
+        """Delete the outputs which were not produced by the current run and compact the manifest"""
+        self._file.close()
+        orphans = set(self.previous) - set(self.current)
+        for output in orphans:
+            try:
+                os.remove(os.path.join(self.task_dir, output))
+            except FileNotFoundError:
+                pass
+        if orphans:
+            logging.info(f'Removed {len(orphans)} orphaned outputs from {self.task_dir}')
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self.current.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.path)
@@ -1,8 +1,20 @@
 import os
+import logging
 import pandas as pd
 from tqdm import tqdm
 
 
+RENAMED_COLUMNS = {
+    'left or right breast': 'left_or_right_breast',
+    'image view': 'image_view',
+    'abnormality id': 'abnormality_id',
+    'mass shape': 'mass_shape',
+    'mass margins': 'mass_margins',
+    'image file path': 'image_file_path',
+    'cropped image file path': 'cropped_image_file_path',
+    'ROI mask file path': 'roi_mask_file_path'}
+
+
 def normalize_and_format_path(path: str) -> str:
     if path.startswith(".\\"):
         path = path[2:]
@@ -25,9 +37,77 @@ def get_image_path_ids(row, key):
     return study_id, series_uid
 
 
+def normalize_and_format_paths(paths: pd.Series) -> pd.Series:
+    """Vectorized version of normalize_and_format_path
+
+    Args:
+        paths (pd.Series): metadata file locations
+
+    Returns:
+        pd.Series: normalized paths
+    """
+    paths = paths.str.replace(r"^\.\\", "", regex=True).str.replace("\\", "/", regex=False)
+    parts = paths.str.rpartition("/")
+    last_part = parts[2].str.split("-", n=1, expand=True).reindex(columns=[0, 1])
+    number = last_part[0]
+    number = number.where(~number.str.isdigit(), number.str.zfill(2))
+    return parts[0] + parts[1] + number + "-" + last_part[1].fillna("")
+
+
+def build_metadata_index(metadata_df: pd.DataFrame) -> pd.Series:
+    """Build a (Study UID, Series UID) -> normalized File Location index
+
+    Args:
+        metadata_df (pd.DataFrame): content of the metadata.csv file
+
+    Returns:
+        pd.Series: normalized file locations indexed by study and series uids
+    """
+    index = metadata_df.drop_duplicates(['Study UID', 'Series UID'])
+    return pd.Series(
+        normalize_and_format_paths(index['File Location']).values,
+        index=pd.MultiIndex.from_frame(index[['Study UID', 'Series UID']]),
+        name='File Location')
+
+
+def get_image_paths_ids(df: pd.DataFrame, key: str) -> pd.MultiIndex:
+    """Vectorized version of get_image_path_ids
+
+    Args:
+        df (pd.DataFrame): case description dataframe
+        key (str): column holding the file paths
+
+    Returns:
+        pd.MultiIndex: (Study UID, Series UID) of each row
+    """
+    path_segment = df[key].str.split(os.sep)
+    return pd.MultiIndex.from_arrays([path_segment.str[1], path_segment.str[2]],
+                                     names=['Study UID', 'Series UID'])
+
+
+def correct_lesion_description(df: pd.DataFrame, metadata_index: pd.Series):
+    """Replace the file paths of a case description dataframe with the actual file locations
+
+    Args:
+        df (pd.DataFrame): case description dataframe with renamed columns
+        metadata_index (pd.Series): index returned by build_metadata_index
+
+    Returns:
+        tuple: (corrected dataframe, boolean mask of the rows without metadata match)
+    """
+    df = df.copy()
+    unmatched = pd.Series(False, index=df.index)
+    for column in ['image_file_path', 'roi_mask_file_path', 'cropped_image_file_path']:
+        corrected = metadata_index.reindex(get_image_paths_ids(df, column))
+        unmatched |= corrected.isna().values
+        df[column] = corrected.values
+    return df, unmatched
+
+
 def correct_metadata_files(data_dir: str):
 
     metadata_df = pd.read_csv(os.path.join(data_dir, 'metadata.csv'))
+    metadata_index = build_metadata_index(metadata_df)
 
     lesion_description_files = {
         f"{desc}_case_description_{set_type}_set": os.path.join(data_dir, f"{desc}_case_description_{set_type}_set.csv")
@@ -38,41 +118,14 @@ def correct_metadata_files(data_dir: str):
     with tqdm(total=len(lesion_description_files.keys()), desc='Correcting csv files') as pbar:
         for key in lesion_description_files.keys():
             df = pd.read_csv(lesion_description_files[key])
-            df = df.rename(columns={
-                'left or right breast': 'left_or_right_breast',
-                'image view': 'image_view',
-                'abnormality id': 'abnormality_id',
-                'mass shape': 'mass_shape',
-                'mass margins': 'mass_margins',
-                'image file path': 'image_file_path',
-                'cropped image file path': 'cropped_image_file_path',
-                'ROI mask file path': 'roi_mask_file_path'})
-
-            for idx, row in df.iterrows():
-                image_study_id, image_series_uid = get_image_path_ids(
-                    row, 'image_file_path')
-                roi_study_id, roi_series_uid = get_image_path_ids(
-                    row, 'roi_mask_file_path')
-                cropped_study_id, cropped_series_uid = get_image_path_ids(
-                    row, 'cropped_image_file_path')
-
-                meta_image = metadata_df[(metadata_df['Series UID'] == image_series_uid) & (
-                    metadata_df['Study UID'] == image_study_id)]
-                meta_roi = metadata_df[(metadata_df['Series UID'] == roi_series_uid) & (
-                    metadata_df['Study UID'] == roi_study_id)]
-                meta_cropped = metadata_df[(metadata_df['Series UID'] == cropped_series_uid) & (
-                    metadata_df['Study UID'] == cropped_study_id)]
-
-                correct_img_path = meta_image['File Location'].values[0]
-                correct_roi_path = meta_roi['File Location'].values[0]
-                correct_cropped_path = meta_cropped['File Location'].values[0]
-
-                df.loc[idx, 'image_file_path'] = normalize_and_format_path(
-                    correct_img_path)
-                df.loc[idx, 'roi_mask_file_path'] = normalize_and_format_path(
-                    correct_roi_path)
-                df.loc[idx, 'cropped_image_file_path'] = normalize_and_format_path(
-                    correct_cropped_path)
+            df = df.rename(columns=RENAMED_COLUMNS)
+            df, unmatched = correct_lesion_description(df, metadata_index)
+
+            if unmatched.any():
+                logging.warning(
+                    f'{key}: {unmatched.sum()} rows have no match in metadata.csv and are skipped '
+                    f'(patients {", ".join(df.loc[unmatched, "patient_id"].astype(str).unique())})')
+                df = df[~unmatched]
 
             df.to_csv(os.path.join(data_dir, key + '_corrected.csv'))
             pbar.update()
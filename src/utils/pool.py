@@ -0,0 +1,97 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _call_chunk(fn, chunk: list):
+    return [fn(*args) for args in chunk]
+
+
+class WorkerPool:
+    """Process pool shared by all the stages of a run.
+
+    Work items are sent to the workers in chunks to amortize the inter-process
+    communication, the chunk size being derived from the number of items when not
+    given explicitly.
+
+    By default every item of a map is submitted at once. With ``max_inflight``, at most
+    that many items are submitted and not yet consumed by the caller, so that the
+    number of images being processed or waiting to be collected stays bounded.
+
+    Args:
+        workers (int): Number of worker processes, defaults to the number of cpus
+        chunksize (int): Number of items sent to a worker at once, None for automatic
+        profiler (Profiler): Optional profiler collecting the stage timings of the mapped functions
+        max_inflight (int): Maximum number of items submitted and not yet consumed, None for no limit
+    """
+
+    def __init__(self, workers: int = None, chunksize: int = None, profiler=None, max_inflight: int = None):
+        self.workers = workers or os.cpu_count()
+        self.chunksize = chunksize
+        self.profiler = profiler
+        self.max_inflight = max_inflight
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def get_chunksize(self, total: int):
+        if self.chunksize is not None:
+            return self.chunksize
+        # Small enough chunks for the last, smallest, items to balance the workers load
+        return min(32, max(1, total // (self.workers * 8)))
+
+    def map(self, fn, *iterables, total: int, prefetch=None):
+        """Lazily apply fn to the items of the iterables, results are yielded in order
+
+        Args:
+            fn (callable): picklable function
+            iterables: argument iterables, as for the builtin map
+            total (int): number of items, used to choose the chunk size
+            prefetch (callable): Optional function called with the arguments of each item
+                max_inflight items before it is submitted, only used with max_inflight
+        """
+        name = fn.__name__
+        if self.profiler is not None:
+            fn = self.profiler.wrap(fn)
+        if self.max_inflight is None:
+            results = self._executor.map(fn, *iterables, chunksize=self.get_chunksize(total))
+        else:
+            results = self._bounded_map(fn, zip(*iterables), total, prefetch)
+        if self.profiler is None:
+            return results
+        return self.profiler.unwrap(results, name, self.workers)
+
+    def _bounded_map(self, fn, items, total: int, prefetch=None):
+        chunksize = max(1, min(self.get_chunksize(total), self.max_inflight // self.workers))
+        max_chunks = max(1, self.max_inflight // chunksize)
+        upcoming = deque()
+        pending = deque()
+
+        def fill():
+            # Items are announced to prefetch one window ahead of their submission
+            while len(upcoming) < max_chunks * chunksize:
+                item = next(items, None)
+                if item is None:
+                    break
+                if prefetch is not None:
+                    prefetch(*item)
+                upcoming.append(item)
+            while len(pending) < max_chunks and upcoming:
+                chunk = [upcoming.popleft() for _ in range(min(chunksize, len(upcoming)))]
+                pending.append(self._executor.submit(_call_chunk, fn, chunk))
+
+        fill()
+        while pending:
+            results = pending.popleft().result()
+            fill()
+            yield from results
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
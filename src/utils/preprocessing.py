@@ -1,5 +1,38 @@
 import cv2
+import logging
 import numpy as np
+from functools import lru_cache
+
+
+# Clip limits of the second and third channels of the synthetized images
+SYNTHESIS_CLIPS = (1.0, 2.0)
+CLAHE_TILES = (8, 8)
+HIST_SIZE = 256
+# Image shapes of check_clahe_luts, divisible or not by the tile grid on each axis
+CLAHE_CHECK_SHAPES = ((64, 64), (67, 93), (130, 56), (200, 257))
+
+
+def histogram_percentile(counts: np.array, q: float):
+    """np.percentile, with the default linear method, of the values whose histogram is given
+
+    Args:
+        counts (np.array): number of occurrences of each value
+        q (float): percentile, between 0 and 100
+
+    Returns:
+        float: percentile
+    """
+    n = int(counts.sum())
+    cdf = np.cumsum(counts)
+    index = np.true_divide(q, 100) * (n - 1)
+    below = np.floor(index)
+    t = index - below
+    # The value at sorted position k is the first one whose cumulative count exceeds k
+    a = float(np.searchsorted(cdf, below, side='right'))
+    b = float(np.searchsorted(cdf, min(below + 1, n - 1), side='right'))
+    diff = b - a
+    # Same interpolation as numpy, from the closest of the two values
+    return b - diff * (1 - t) if t >= 0.5 else a + diff * t
 
 
 def truncate_normalization(img: np.array, mask: np.array):
@@ -12,6 +45,16 @@ def truncate_normalization(img: np.array, mask: np.array):
     Returns:
         np.array: normalized image
     """
+    if img.dtype == np.uint8:
+        # Same computation on the 256 possible values, applied through a lookup table
+        inside = (mask != 0).astype(np.uint8)
+        counts = cv2.calcHist([img], [0], inside, [HIST_SIZE], [0, HIST_SIZE]).ravel()
+        Pmin, Pmax = histogram_percentile(counts, 2), histogram_percentile(counts, 99)
+        values = np.clip(np.arange(HIST_SIZE), Pmin, Pmax)
+        lut = np.array((values - Pmin) / (Pmax - Pmin) * 255, dtype=np.uint8)
+        normalized = cv2.LUT(img, lut)
+        normalized[inside == 0] = 0
+        return normalized
     Pmin = np.percentile(img[mask != 0], 2)
     Pmax = np.percentile(img[mask != 0], 99)
     truncated = np.clip(img, Pmin, Pmax)
@@ -20,6 +63,12 @@ def truncate_normalization(img: np.array, mask: np.array):
     return np.array(normalized * 255, dtype=np.uint8)
 
 
+@lru_cache(maxsize=None)
+def get_clahe(clip: float):
+    """CLAHE instance of the current process for a clip limit, created once"""
+    return cv2.createCLAHE(clipLimit=clip, tileGridSize=CLAHE_TILES)
+
+
 def clahe(img, clip=1.5):
     """
     Image enhancement.
@@ -27,6 +76,153 @@ def clahe(img, clip=1.5):
     @clip : float, clip limit for CLAHE algorithm
     return: numpy array of the enhanced image
     """
-    clahe = cv2.createCLAHE(clipLimit=clip)
-    cl = clahe.apply(img)
-    return cl
+    return get_clahe(clip).apply(img)
+
+
+def clahe_luts(img, clips: tuple = SYNTHESIS_CLIPS):
+    """Per tile lookup tables of OpenCV's CLAHE for several clip limits.
+    The tile histograms are computed once and clipped with each limit, following
+    cv2.createCLAHE so that apply_clahe_luts gives the same pixels as clahe.
+
+    Args:
+        img (np.array): uint8 image
+        clips (tuple): clip limits
+
+    Returns:
+        tuple: (uint8 array of shape (len(clips), tiles y, tiles x, 256), tile size (height, width))
+    """
+    tiles_y, tiles_x = CLAHE_TILES
+    height, width = img.shape
+    src = img
+    if height % tiles_y or width % tiles_x:
+        # OpenCV pads both axes as soon as one of them is not divisible
+        src = cv2.copyMakeBorder(img, 0, tiles_y - height % tiles_y, 0, tiles_x - width % tiles_x,
+                                 cv2.BORDER_REFLECT_101)
+    tile_h, tile_w = src.shape[0] // tiles_y, src.shape[1] // tiles_x
+    tile_area = tile_h * tile_w
+    hists = np.empty((tiles_y, tiles_x, HIST_SIZE), dtype=np.int64)
+    for ty in range(tiles_y):
+        for tx in range(tiles_x):
+            tile = src[ty * tile_h:(ty + 1) * tile_h, tx * tile_w:(tx + 1) * tile_w]
+            hists[ty, tx] = cv2.calcHist([tile], [0], None, [HIST_SIZE], [0, HIST_SIZE]).ravel()
+
+    luts = np.empty((len(clips), tiles_y, tiles_x, HIST_SIZE), dtype=np.uint8)
+    for c, clip in enumerate(clips):
+        hist = hists.copy()
+        if clip > 0:
+            limit = max(int(clip * tile_area / HIST_SIZE), 1)
+            clipped = np.maximum(hist - limit, 0).sum(axis=-1)
+            np.minimum(hist, limit, out=hist)
+            batch = clipped // HIST_SIZE
+            hist += batch[..., None]
+            # The remaining counts are spread one by one with a regular step from the first bin
+            for ty, tx in zip(*np.nonzero(clipped - batch * HIST_SIZE)):
+                residual = int(clipped[ty, tx] - batch[ty, tx] * HIST_SIZE)
+                hist[ty, tx, ::max(HIST_SIZE // residual, 1)][:residual] += 1
+        cdf = np.cumsum(hist, axis=-1).astype(np.float32) * np.float32((HIST_SIZE - 1) / tile_area)
+        luts[c] = np.clip(np.rint(cdf), 0, 255)
+    return luts, (tile_h, tile_w)
+
+
+def _tile_weights(coords, tile: int, n_tiles: int):
+    """Neighbour tiles and interpolation weights of pixel coordinates along one axis, in float32 as OpenCV"""
+    pos = coords.astype(np.float32) * (np.float32(1.0) / np.float32(tile)) - np.float32(0.5)
+    first = np.floor(pos).astype(np.intp)
+    weight = (pos - first).astype(np.float32)
+    return np.maximum(first, 0), np.minimum(first + 1, n_tiles - 1), np.float32(1.0) - weight, weight
+
+
+def apply_clahe_luts(img, luts, tile_size: tuple, rows=None, cols=None):
+    """Compute CLAHE on a subset of the pixels of an image, see clahe_luts.
+    Only the pixels at the given rows and columns are interpolated, giving the same
+    values as applying clahe to the whole image and indexing the result.
+
+    Args:
+        img (np.array): uint8 image the lookup tables were computed from
+        luts (np.array): lookup tables, see clahe_luts
+        tile_size (tuple): tile size, see clahe_luts
+        rows (np.array): row indices, all rows if None
+        cols (np.array): column indices, all columns if None
+
+    Returns:
+        list: one uint8 array of shape (len(rows), len(cols)) per clip limit
+    """
+    tiles_x = luts.shape[2]
+    rows = np.arange(img.shape[0]) if rows is None else np.asarray(rows)
+    cols = np.arange(img.shape[1]) if cols is None else np.asarray(cols)
+    y1, y2, wy1, wy2 = _tile_weights(rows, tile_size[0], luts.shape[1])
+    x1, x2, wx1, wx2 = _tile_weights(cols, tile_size[1], tiles_x)
+    flat = luts.reshape(len(luts), -1)
+    outputs = [np.empty((len(rows), len(cols)), dtype=np.uint8) for _ in luts]
+    # Numpy indexes with intp, work on row blocks to avoid large int64 copies
+    block = max(1, (1 << 18) // max(len(cols), 1))
+    for start in range(0, len(rows), block):
+        b = slice(start, start + block)
+        values = img[rows[b]][:, cols]
+        corners = [((y[b, None] * tiles_x + x) * HIST_SIZE + values) for y in (y1, y2) for x in (x1, x2)]
+        for lut, out in zip(flat, outputs):
+            v11, v12, v21, v22 = (lut.take(corner) for corner in corners)
+            res = (v11 * wx1 + v12 * wx2) * wy1[b, None] + (v21 * wx1 + v22 * wx2) * wy2[b, None]
+            np.clip(np.rint(res), 0, 255, out=res)
+            out[b] = res
+    return outputs
+
+
+@lru_cache(maxsize=None)
+def check_clahe_luts():
+    """Check that clahe_luts and apply_clahe_luts still give the pixels of cv2.createCLAHE with the
+    installed OpenCV version, on a few image shapes. Run once per process before the first
+    sparse synthesis, as a change of the OpenCV implementation would silently change the outputs.
+
+    Returns:
+        bool: True if every pixel matches, otherwise a warning is logged and synthetize_image
+            falls back to cv2.createCLAHE on the whole image
+    """
+    rng = np.random.default_rng(0)
+    for shape in CLAHE_CHECK_SHAPES:
+        # Skewed intensities and a gradient, so that the histograms are clipped with residuals
+        img = (rng.random(shape) ** 3 * 128 + np.linspace(0, 127, shape[1])).astype(np.uint8)
+        luts, tile_size = clahe_luts(img)
+        rows, cols = np.arange(0, shape[0], 3), np.arange(1, shape[1], 2)
+        for clip, full, sparse in zip(SYNTHESIS_CLIPS, apply_clahe_luts(img, luts, tile_size),
+                                      apply_clahe_luts(img, luts, tile_size, rows, cols)):
+            expected = clahe(img, clip)
+            if not np.array_equal(full, expected) or not np.array_equal(sparse, expected[rows][:, cols]):
+                logging.warning(f'clahe_luts does not match cv2.createCLAHE of OpenCV {cv2.__version__} on a '
+                                f'{shape} image with clip {clip}, the whole images are synthetized instead')
+                return False
+    return True
+
+
+def synthetize_image(img, rows=None, cols=None, luts=None):
+    """Three channels image made of the original image and its CLAHE enhanced
+    versions at the SYNTHESIS_CLIPS clip limits
+
+    Args:
+        img (np.array): uint8 image
+        rows (np.array): when given with cols, only these pixels are synthetized
+        cols (np.array): see rows
+        luts (tuple): output of clahe_luts(img), computed if not given
+
+    Returns:
+        np.array: uint8 image with 3 channels
+    """
+    if rows is None and cols is None:
+        return cv2.merge((img, *(clahe(img, clip) for clip in SYNTHESIS_CLIPS)))
+    if not check_clahe_luts():
+        synthetized = synthetize_image(img)
+        rows = slice(None) if rows is None else np.asarray(rows)
+        cols = slice(None) if cols is None else np.asarray(cols)
+        return np.ascontiguousarray(synthetized[rows][:, cols])
+    luts, tile_size = luts if luts is not None else clahe_luts(img)
+    return cv2.merge((img[np.asarray(rows)][:, np.asarray(cols)],
+                      *apply_clahe_luts(img, luts, tile_size, rows, cols)))
+
+
+def linear_resize_support(src_size: int, dst_size: int):
+    """Source indices read by cv2.resize with INTER_LINEAR along one axis.
+    OpenCV computes the source positions in single precision, positions rounded both
+    ways are kept so that no index read by the resize is missed."""
+    pos = (np.arange(dst_size) + 0.5) * (src_size / dst_size) - 0.5
+    first = np.concatenate([np.floor(pos), np.floor(pos.astype(np.float32))]).astype(np.intp)
+    return np.unique(np.clip(np.concatenate([first, first + 1]), 0, src_size - 1))
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import cProfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+
+
+# Timings of the current process, reset before each profiled call
+_enabled = False
+_stages = defaultdict(float)
+_bytes = {'read': 0, 'written': 0}
+_lock = threading.Lock()
+_cprofile = None
+
+# Histogram bins of the stage durations, in seconds
+HISTOGRAM_EDGES = [0, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1, 2, 5, float('inf')]
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    """Start collecting stage timings in the current process"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop collecting stage timings in the current process and drop the uncollected ones"""
+    global _enabled
+    _enabled = False
+    _collect()
+
+
+@contextmanager
+def stage(name: str):
+    """Add the time spent in the block to a stage of the current call, does nothing when profiling is disabled"""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _stages[name] += elapsed
+
+
+def add_bytes(read: int = 0, written: int = 0):
+    """Count bytes read from or written to disk by the current call"""
+    if not _enabled:
+        return
+    with _lock:
+        _bytes['read'] += read
+        _bytes['written'] += written
+
+
+def _collect():
+    """Timings gathered since the last collection, which are reset"""
+    with _lock:
+        stages, read, written = dict(_stages), _bytes['read'], _bytes['written']
+        _stages.clear()
+        _bytes['read'] = _bytes['written'] = 0
+    return stages, read, written
+
+
+def _dump_cprofile(profile: cProfile.Profile, path: str):
+    profile.dump_stats(path)
+
+
+def _start_cprofile(cprofile_dir: str):
+    """cProfile of the current process, dumped to cprofile_dir when the process exits"""
+    global _cprofile
+    if _cprofile is None:
+        os.makedirs(cprofile_dir, exist_ok=True)
+        _cprofile = cProfile.Profile()
+        Finalize(None, _dump_cprofile, args=(_cprofile, os.path.join(cprofile_dir, f'worker-{os.getpid()}.prof')),
+                 exitpriority=10)
+    return _cprofile
+
+
+def _label(item):
+    return item if isinstance(item, str) else repr(item)
+
+
+class ProfiledCall:
+    """Picklable wrapper of a worker function returning its result along with the
+    stage timings and bytes read and written during the call.
+
+    Args:
+        fn (callable): worker function
+        cprofile_dir (str): Folder where each worker dumps its cProfile statistics, None to disable cProfile
+    """
+
+    def __init__(self, fn, cprofile_dir: str = None):
+        self.fn = fn
+        self.cprofile_dir = cprofile_dir
+
+    def __call__(self, *args):
+        enable()
+        _collect()
+        profile = _start_cprofile(self.cprofile_dir) if self.cprofile_dir else None
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            result = self.fn(*args)
+        finally:
+            if profile is not None:
+                profile.disable()
+        seconds = time.perf_counter() - start
+        stages, read, written = _collect()
+        return result, {'label': _label(args[0]) if args else None, 'seconds': seconds, 'stages': stages,
+                        'bytes_read': read, 'bytes_written': written}
+
+
+class Profiler:
+    """Aggregate the timings sent back by the workers of a WorkerPool.
+
+    Every function mapped by the pool is wrapped in a ProfiledCall, the timings of each
+    call are recorded under the function name, along with the wall time of each map to
+    estimate the pool overhead. Stages run by the main process are also recorded.
+
+    Args:
+        cprofile_dir (str): Folder where each worker dumps its cProfile statistics when it exits,
+            None to disable cProfile
+    """
+
+    def __init__(self, cprofile_dir: str = None):
+        self.cprofile_dir = cprofile_dir
+        self.calls = defaultdict(list)
+        self.maps = defaultdict(lambda: {'wall': 0.0, 'workers': 0})
+        enable()
+        _collect()
+
+    def wrap(self, fn):
+        return ProfiledCall(fn, self.cprofile_dir)
+
+    def close(self):
+        """Stop collecting stage timings in the current process, once the report is made"""
+        disable()
+
+    def unwrap(self, results, name: str, workers: int):
+        """Record the timings of the profiled calls and yield their results"""
+        pool = self.maps[name]
+        pool['workers'] = workers
+        # Updated after every result, the caller may stop iterating before the end of the map
+        wall, start = pool['wall'], time.perf_counter()
+        for result, call in results:
+            self.calls[name].append(call)
+            pool['wall'] = wall + time.perf_counter() - start
+            yield result
+
+    def summary(self, slowest: int = 10):
+        """Per stage statistics and histograms, slowest calls, bytes read and written and pool usage
+
+        Args:
+            slowest (int): number of slowest calls listed for each function
+
+        Returns:
+            dict: json serializable summary
+        """
+        main_stages, main_read, main_written = _collect()
+        summary = {'main_process': {'stages': main_stages, 'bytes_read': main_read, 'bytes_written': main_written}}
+        for name, calls in self.calls.items():
+            stage_samples = defaultdict(list)
+            for call in calls:
+                for stage_name, seconds in call['stages'].items():
+                    stage_samples[stage_name].append(seconds)
+                stage_samples['total'].append(call['seconds'])
+            busy = sum(call['seconds'] for call in calls)
+            pool = self.maps[name]
+            summary[name] = {
+                'calls': len(calls),
+                'bytes_read': sum(call['bytes_read'] for call in calls),
+                'bytes_written': sum(call['bytes_written'] for call in calls),
+                'pool': {'wall': pool['wall'], 'workers': pool['workers'], 'worker_seconds': busy,
+                         'utilization': busy / (pool['wall'] * pool['workers']) if pool['wall'] > 0 else None},
+                'stages': {stage_name: self._stage_summary(samples)
+                           for stage_name, samples in stage_samples.items()},
+                'slowest': sorted(calls, key=lambda call: call['seconds'], reverse=True)[:slowest],
+            }
+        return summary
+
+    @staticmethod
+    def _stage_summary(samples: list):
+        import numpy as np
+        samples = np.array(samples)
+        counts, _ = np.histogram(samples, bins=HISTOGRAM_EDGES)
+        p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+        return {'calls': len(samples), 'total': float(samples.sum()), 'mean': float(samples.mean()),
+                'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(samples.max()),
+                'histogram': {'edges': HISTOGRAM_EDGES[:-1], 'counts': counts.tolist()}}
+
+    def report(self, path: str = None, slowest: int = 10):
+        """Print the summary and save it as json when a path is given"""
+        summary = self.summary(slowest)
+        for name, fn_summary in summary.items():
+            if name == 'main_process':
+                continue
+            pool = fn_summary['pool']
+            utilization = f"{pool['utilization']:.0%}" if pool['utilization'] is not None else '-'
+            print(f"\n{name}: {fn_summary['calls']} calls, {pool['wall']:.2f}s wall on {pool['workers']} workers "
+                  f"({utilization} busy), read {fn_summary['bytes_read'] / 1e6:.1f} MB, "
+                  f"written {fn_summary['bytes_written'] / 1e6:.1f} MB")
+            print(f"  {'stage':20s} {'total':>9s} {'mean':>9s} {'p50':>9s} {'p90':>9s} {'p99':>9s} {'max':>9s}")
+            for stage_name, s in sorted(fn_summary['stages'].items(), key=lambda item: -item[1]['total']):
+                print(f"  {stage_name:20s} {s['total']:9.3f} {s['mean']:9.4f} {s['p50']:9.4f} "
+                      f"{s['p90']:9.4f} {s['p99']:9.4f} {s['max']:9.4f}")
+            print('  slowest:')
+            for call in fn_summary['slowest']:
+                print(f"    {call['seconds']:8.3f}s {call['label']}")
+        main_stages = summary['main_process']['stages']
+        if main_stages:
+            print('\nmain process: ' + ', '.join(f'{k} {v:.2f}s' for k, v in main_stages.items()))
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
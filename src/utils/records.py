@@ -0,0 +1,86 @@
+import os
+import logging
+import pandas as pd
+
+
+class CaseRecord:
+    """Compact, cheap to pickle, version of a corrected case description row.
+
+    Fields can be read either as attributes or with the csv column names, like a
+    pandas row, and ``name`` holds the row index used to name the outputs.
+    The DICOM files of the row, their sizes and shapes, are filled by ``resolve_dicom_files``.
+    """
+    __slots__ = ('name', 'patient_id', 'left_or_right_breast', 'image_view', 'abnormality_id',
+                 'abnormality_type', 'pathology', 'image_file_path', 'roi_mask_file_path',
+                 'image_file', 'image_size', 'image_shape', 'mask_files', 'mask_shapes')
+
+    # csv column -> attribute
+    COLUMNS = {
+        'patient_id': 'patient_id',
+        'left_or_right_breast': 'left_or_right_breast',
+        'image_view': 'image_view',
+        'abnormality_id': 'abnormality_id',
+        'abnormality type': 'abnormality_type',
+        'pathology': 'pathology',
+        'image_file_path': 'image_file_path',
+        'roi_mask_file_path': 'roi_mask_file_path',
+    }
+
+    def __init__(self, name, **fields):
+        self.name = name
+        for attribute in self.__slots__[1:]:
+            setattr(self, attribute, fields.get(attribute))
+
+    def __getitem__(self, key):
+        return getattr(self, self.COLUMNS.get(key, key))
+
+    def __repr__(self):
+        return f'CaseRecord({self.name}, {self.image_file_path})'
+
+
+def read_case_records(csv_data_file: str):
+    """Read a corrected csv file as a list of CaseRecord
+
+    Args:
+        csv_data_file (str): Path to a corrected case description file
+
+    Returns:
+        list: one CaseRecord per row
+    """
+    df = pd.read_csv(csv_data_file)
+    columns = [c for c in CaseRecord.COLUMNS if c in df.columns]
+    attributes = [CaseRecord.COLUMNS[c] for c in columns]
+    return [CaseRecord(name, **dict(zip(attributes, values)))
+            for name, values in zip(df.index, df[columns].itertuples(index=False, name=None))]
+
+
+def resolve_dicom_files(records: list, data_dir: str, dicom_index: pd.DataFrame):
+    """Fill the DICOM files of each record from the DICOM index, see load_dicom_index.
+    The mammogram size is used to schedule the largest images first.
+
+    Args:
+        records (list): CaseRecord list, updated in place
+        data_dir (str): Path to original cbis dataset
+        dicom_index (pd.DataFrame): DICOM files index
+
+    Returns:
+        list: the records whose mammogram file was found, the others are logged and skipped
+    """
+    series = {}
+    for series_path, file_name, size, rows, columns in dicom_index[
+            ['series_path', 'file_name', 'size', 'rows', 'columns']].itertuples(index=False, name=None):
+        series.setdefault(series_path, []).append(
+            (os.path.join(data_dir, series_path, file_name), size, (rows, columns) if rows > 0 else None))
+
+    resolved = []
+    for record in records:
+        if not series.get(record.image_file_path):
+            logging.error(f'Failed to process row {record.name}: no DICOM file found in {record.image_file_path}')
+            continue
+        resolved.append(record)
+        image_path, record.image_size, record.image_shape = series[record.image_file_path][0]
+        record.image_file = image_path
+        masks = series.get(record.roi_mask_file_path, [])
+        record.mask_files = [path for path, _, _ in masks]
+        record.mask_shapes = [shape for _, _, shape in masks]
+    return resolved
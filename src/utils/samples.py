@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+SAMPLES_NAME = 'samples.csv'
+# Metadata of the case description row copied in the table for every output
+RECORD_COLUMNS = ('name', 'patient_id', 'left_or_right_breast', 'image_view', 'abnormality_id',
+                  'abnormality_type', 'pathology', 'image_file_path', 'roi_mask_file_path', 'image_file')
+
+
+def sample_row(output: str, split: str, label: str, record, labels: str = None):
+    """Row of the sample table describing one output
+
+    Args:
+        output (str): output file path relative to the task folder, or ``split/key`` for shard samples
+        split (str): 'train' or 'test'
+        label (str): class of the output, the name of its label folder
+        record (CaseRecord): case description row the output was built from
+        labels (str): labels of all the abnormalities of the image, '|' separated, the label if not given
+
+    Returns:
+        dict: table row
+    """
+    row = {'output': output, 'split': split, 'label': label, 'labels': labels or label, 'fold': -1, 'source': None}
+    row.update((column, getattr(record, column)) for column in RECORD_COLUMNS)
+    return row
+
+
+def assign_folds(groups: list, labels: list, folds: int, seed: int = 0):
+    """Split groups in folds with similar label distributions, all the samples of a group
+    being in the same fold. Groups are placed one at a time, largest first, in the fold
+    where they keep the label proportions of the folds the closest.
+
+    Args:
+        groups (list): group of each sample, e.g. the patient id
+        labels (list): label of each sample
+        folds (int): number of folds
+        seed (int): seed used to order groups of the same size
+
+    Returns:
+        dict: group -> fold
+    """
+    counts = pd.crosstab(pd.Series(groups, name='group'), pd.Series(labels, name='label'))
+    rng = np.random.default_rng(seed)
+    counts = counts.iloc[rng.permutation(len(counts))]
+    order = np.argsort(-counts.to_numpy().sum(axis=1), kind='stable')
+    totals = counts.to_numpy().sum(axis=0)
+
+    fold_counts = np.zeros((folds, counts.shape[1]))
+    assignment = {}
+    for i in order:
+        group_counts = counts.iloc[i].to_numpy()
+        best_fold, best_score = None, None
+        for fold in range(folds):
+            fold_counts[fold] += group_counts
+            # Spread across folds of the share of each label, then fold size to break ties
+            score = (np.std(fold_counts / totals, axis=0).mean(), fold_counts[fold].sum())
+            fold_counts[fold] -= group_counts
+            if best_score is None or score < best_score:
+                best_fold, best_score = fold, score
+        fold_counts[best_fold] += group_counts
+        assignment[counts.index[i]] = best_fold
+    return assignment
+
+
+def write_sample_table(task_dir: str, rows: list, patient_folds: dict = None):
+    """Save the sample table of a prepared task, sorted by output
+
+    Args:
+        task_dir (str): Folder of the prepared task
+        rows (list): table rows, see sample_row
+        patient_folds (dict): patient id -> fold of the train samples, see assign_folds
+    """
+    table = pd.DataFrame(rows, columns=['output', 'split', 'label', 'labels', 'fold', 'source',
+                                       *RECORD_COLUMNS])
+    if patient_folds:
+        train = table['split'] == 'train'
+        table.loc[train, 'fold'] = table.loc[train, 'patient_id'].map(patient_folds).fillna(-1).astype(int)
+    table.sort_values('output').to_csv(os.path.join(task_dir, SAMPLES_NAME), index=False)
+
+
+def read_sample_table(task_dir: str):
+    """Sample table of a prepared task, None if the task has none"""
+    path = os.path.join(task_dir, SAMPLES_NAME)
+    return pd.read_csv(path) if os.path.exists(path) else None
+
+
+def add_augmented_samples(task_dir: str, split: str, augmented: dict):
+    """Replace the augmented samples of a split in the sample table of its task.
+    Augmented samples copy the metadata and fold of their source and give it in the 'source' column.
+
+    Args:
+        task_dir (str): Folder of the prepared task
+        split (str): augmented split
+        augmented (dict): source output -> list of augmented outputs, as given in the 'output' column
+    """
+    table = read_sample_table(task_dir)
+    if table is None:
+        return
+    table = table[(table['split'] != split) | table['source'].isna()]
+    sources = table.set_index('output')
+    rows = [dict(sources.loc[source], output=output, source=source)
+            for source, outputs in augmented.items() if source in sources.index for output in outputs]
+    table = pd.concat([table, pd.DataFrame(rows, columns=table.columns)], ignore_index=True)
+    table.sort_values('output').to_csv(os.path.join(task_dir, SAMPLES_NAME), index=False)
+
+
+def fold_split(table: pd.DataFrame, fold: int):
+    """Training and validation samples of a cross validation fold, the test split is left out
+
+    Args:
+        table (pd.DataFrame): sample table, see read_sample_table
+        fold (int): validation fold
+
+    Returns:
+        tuple: (training samples, validation samples), the augmented versions of the
+            validation images are excluded from both
+    """
+    train = table[table['split'] == 'train']
+    validation = train['fold'] == fold
+    return train[~validation], train[validation & train['source'].isna()]
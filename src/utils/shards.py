@@ -0,0 +1,178 @@
+import io
+import os
+import json
+import tarfile
+import numpy as np
+import pandas as pd
+
+
+INDEX_NAME = 'index.csv'
+
+
+class ShardWriter:
+    """Pack the images of a prepared split in fixed size shards.
+
+    Samples are buffered and written ``shard_size`` at a time, so that the split is
+    stored as a few large files instead of one small file per image. Each sample
+    gets one row in the ``index.csv`` file of the split giving its shard, its
+    position in the shard, its label and its metadata. Shards are numbered after
+    the existing ones so a writer can add samples to an already packed split.
+
+    Args:
+        split_dir (str): Folder of the split, e.g. out_dir/task/train
+        shard_size (int): Number of samples per shard
+        prefix (str): Shard file name prefix
+    """
+    extension = None
+
+    def __init__(self, split_dir: str, shard_size: int = 1000, prefix: str = 'shard'):
+        self.split_dir = split_dir
+        self.shard_size = shard_size
+        self.prefix = prefix
+        os.makedirs(split_dir, exist_ok=True)
+        self.shard_id = len([f for f in os.listdir(split_dir)
+                             if f.startswith(prefix + '-') and f.endswith(self.extension)])
+        self.buffer = []
+        self.index = []
+
+    def add(self, key: str, image, metadata: dict):
+        """Add a sample
+
+        Args:
+            key (str): sample name, unique in the split
+            image (np.array): uint8 image
+            metadata (dict): label and metadata saved in the index
+        """
+        self.buffer.append((key, np.ascontiguousarray(image), metadata))
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        shard = f'{self.prefix}-{self.shard_id:06d}{self.extension}'
+        for (key, _, metadata), location in zip(self.buffer, self._write_shard(os.path.join(self.split_dir, shard))):
+            self.index.append(dict(key=key, shard=shard, **location, **metadata))
+        self.buffer = []
+        self.shard_id += 1
+
+    def _write_shard(self, path: str):
+        """Write the buffered samples to a shard, returning the location of each sample"""
+        raise NotImplementedError
+
+    def close(self):
+        """Write the remaining samples and append them to the split index"""
+        self.flush()
+        if not self.index:
+            return
+        index_path = os.path.join(self.split_dir, INDEX_NAME)
+        pd.DataFrame(self.index).to_csv(index_path, mode='a', index=False,
+                                        header=not os.path.exists(index_path))
+        self.index = []
+
+
+class TarShardWriter(ShardWriter):
+    """WebDataset style tar shards: each sample is stored as ``key.npy`` and ``key.json`` members.
+    The index gives the byte offset and size of the array data inside the tar file."""
+    extension = '.tar'
+
+    def _write_shard(self, path: str):
+        locations = []
+        with open(path, 'wb') as f, tarfile.open(fileobj=f, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+            for key, image, metadata in self.buffer:
+                buffer = io.BytesIO()
+                np.save(buffer, image)
+                info = tarfile.TarInfo(f'{key}.npy')
+                info.size = buffer.tell()
+                buffer.seek(0)
+                offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+                tar.addfile(info, buffer)
+                locations.append({'offset': offset, 'size': info.size})
+
+                data = json.dumps(dict(key=key, **metadata), default=str).encode()
+                info = tarfile.TarInfo(f'{key}.json')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return locations
+
+
+class NpyShardWriter(ShardWriter):
+    """Numpy shards: the images of a shard are stacked in a single ``.npy`` array
+    which can be memory mapped. The index gives the position of each sample in the array.
+    As augmented images may be cropped, samples are buffered separately for each image shape."""
+    extension = '.npy'
+
+    def __init__(self, split_dir: str, shard_size: int = 1000, prefix: str = 'shard'):
+        super().__init__(split_dir, shard_size, prefix)
+        self.buffers = {}
+
+    def add(self, key: str, image, metadata: dict):
+        # A shard holds a single array, each image shape is packed in its own shards
+        image = np.ascontiguousarray(image)
+        buffer = self.buffers.setdefault(image.shape, [])
+        buffer.append((key, image, metadata))
+        if len(buffer) >= self.shard_size:
+            self._flush_shape(image.shape)
+
+    def flush(self):
+        for shape in list(self.buffers):
+            self._flush_shape(shape)
+
+    def _flush_shape(self, shape: tuple):
+        self.buffer = self.buffers.pop(shape)
+        super().flush()
+
+    def _write_shard(self, path: str):
+        with open(path, 'wb') as f:
+            np.save(f, np.stack([image for _, image, _ in self.buffer]))
+        return [{'offset': i, 'size': image.nbytes} for i, (_, image, _) in enumerate(self.buffer)]
+
+
+def get_shard_writer(output_format: str, split_dir: str, shard_size: int = 1000, prefix: str = 'shard'):
+    writers = {'tar-shards': TarShardWriter, 'npy-shards': NpyShardWriter}
+    return writers[output_format](split_dir, shard_size, prefix)
+
+
+def read_shard_index(split_dir: str):
+    """Index of a packed split, one row per sample"""
+    return pd.read_csv(os.path.join(split_dir, INDEX_NAME))
+
+
+def load_shard_sample(split_dir: str, shard: str, offset: int, size: int = None):
+    """Load the image of a single sample from its shard
+
+    Args:
+        split_dir (str): Folder of the split
+        shard (str): shard file name
+        offset (int): byte offset for tar shards, position in the array for npy shards
+        size (int): size in bytes of the sample, only used by tar shards
+
+    Returns:
+        np.array: uint8 image
+    """
+    path = os.path.join(split_dir, shard)
+    if shard.endswith('.npy'):
+        return np.load(path, mmap_mode='r')[offset]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return np.load(io.BytesIO(f.read(size)))
+
+
+def iter_shard_samples(split_dir: str):
+    """Iterate over the samples of a packed split, reading each shard sequentially
+
+    Yields:
+        tuple: (image, index row as a dict)
+    """
+    index = read_shard_index(split_dir)
+    for shard, rows in index.groupby('shard', sort=False):
+        path = os.path.join(split_dir, shard)
+        if shard.endswith('.npy'):
+            images = np.load(path)
+            for row in rows.to_dict('records'):
+                yield images[row['offset']], row
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+            for row in rows.to_dict('records'):
+                yield np.load(io.BytesIO(data[row['offset']:row['offset'] + row['size']])), row
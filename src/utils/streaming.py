@@ -0,0 +1,87 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.profiling import add_bytes, stage
+
+
+class FilePrefetcher:
+    """Read files in background threads ahead of the workers which will decode them.
+
+    The content is discarded, the point being to have it in the OS page cache when
+    the worker opens the file, so that slow storage reads overlap with the decoding
+    of the previous images without sending the file bytes to the worker processes.
+    Each thread only holds a single read buffer.
+
+    Args:
+        threads (int): Number of reading threads
+        block_size (int): Size of the reads
+    """
+
+    def __init__(self, threads: int = 4, block_size: int = 1 << 20):
+        self.block_size = block_size
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._local = threading.local()
+
+    def _read(self, path: str):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = bytearray(self.block_size)
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while f.readinto(buffer):
+                    pass
+        except OSError:
+            # The worker reports missing or unreadable files
+            pass
+
+    def prefetch(self, paths: list):
+        for path in paths:
+            self._executor.submit(self._read, path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def write_file(path: str, data: bytes):
+    with stage('write'):
+        with open(path, 'wb') as f:
+            f.write(data)
+    add_bytes(written=len(data))
+
+
+class OutputWriter:
+    """Background threads writing encoded outputs produced by the workers.
+
+    At most ``max_pending`` files are queued, ``write`` blocks once the queue is
+    full. The callback of each file is run by the calling thread once the file is
+    written, in submission order, so that it can safely update the manifest.
+
+    Args:
+        threads (int): Number of writing threads
+        max_pending (int): Maximum number of files waiting to be written
+    """
+
+    def __init__(self, threads: int = 4, max_pending: int = 64):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+
+    def _finish_first(self):
+        future, callback = self._pending.popleft()
+        future.result()
+        if callback is not None:
+            callback()
+
+    def write(self, path: str, data: bytes, callback=None):
+        """Queue a file, callback is called without arguments once it is written"""
+        while len(self._pending) >= self.max_pending:
+            self._finish_first()
+        self._pending.append((self._executor.submit(write_file, path, data), callback))
+        while self._pending and self._pending[0][0].done():
+            self._finish_first()
+
+    def close(self):
+        """Wait for the queued files to be written"""
+        while self._pending:
+            self._finish_first()
+        self._executor.shutdown()